@@ -0,0 +1,218 @@
+"""
+Batched microlensing rate calculation over a grid of fields (e.g. OGLE chips).
+
+The lens/src catalog pairs are handed to a pool of worker processes that
+each call microlensing_calculations.mulens_stats. Result rows are appended
+to a partial output file as they finish, and every chip's outcome (with the
+reason for any failure) is appended to an inputs manifest together with the
+size and modification time of its input files and a hash of the
+mulens_stats keyword arguments. Reruns, including restarts after a crash or
+interrupt, then only recompute chips that failed, did not finish, or whose
+lens/src files or keyword arguments changed.
+
+Usage:
+    chips = pd.read_csv('subfs_inmap.csv')
+    run_rates(chips, 'mulens_rates_ogle_0tE300.txt', nsd=True, tE_range=[0,300])
+"""
+
+import os
+import csv
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+import pandas as pd
+from mulens_rates import microlensing_calculations
+import instrument
+
+lens_pattern = 'outputfiles/ogle_chips/lens/Huston2025_l{l:2.3f}_b{b:2.3f}.h5'
+src_pattern = 'outputfiles/ogle_chips/src/Huston2025_l{l:2.3f}_b{b:2.3f}.h5'
+manifest_cols = ['chip', 'l', 'b', 'lens_sig', 'src_sig', 'kwargs_hash', 'status', 'reason']
+
+def file_signature(fname):
+    """
+    Size and modification time of a file ('missing' if it does not exist).
+    """
+    try:
+        st = os.stat(fname)
+    except FileNotFoundError:
+        return 'missing'
+    return f'{st.st_size}:{st.st_mtime_ns}'
+
+def kwargs_hash(kwargs):
+    """
+    Short hash of the mulens_stats keyword arguments, recorded per chip so
+    that rows computed with other settings are not reused.
+    """
+    return hashlib.sha1(json.dumps(kwargs, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+def _rate_job(job):
+    # Runs in a worker process; never raises, so one bad chip cannot stop the batch
+    chip, l, b, f_lens, f_src, kwargs = job
+    for fname in (f_lens, f_src):
+        if not os.path.isfile(fname):
+            return chip, None, None, f'missing input file {fname}'
+    try:
+        with instrument.span('mulens_stats', chip=chip, l=l, b=b) as sp:
+            dat, output_cols = microlensing_calculations.mulens_stats(l, b, f_lens, f_src,
+                                                                      field_id=chip, **kwargs)
+            sp.rows = 1
+    except Exception as e:
+        return chip, None, None, f'{type(e).__name__}: {e}'.replace('\n', ' ')
+    return chip, list(dat), list(output_cols), None
+
+def read_manifest(manifest_file):
+    """
+    Return the per-chip inputs manifest (empty if not written yet), keeping
+    the last record of each chip.
+    """
+    if os.path.isfile(manifest_file) and os.path.getsize(manifest_file)>0:
+        man = pd.read_csv(manifest_file, dtype={'lens_sig':str, 'src_sig':str, 'kwargs_hash':str,
+                                                'reason':str})
+        # Manifests written before kwargs were recorded never match, so those chips are recomputed
+        if 'kwargs_hash' not in man.columns:
+            man['kwargs_hash'] = ''
+        return man.drop_duplicates('chip', keep='last')[manifest_cols]
+    return pd.DataFrame(columns=manifest_cols)
+
+def _write_manifest(manifest_file, man):
+    tmp = manifest_file+f'.{os.getpid()}.tmp'
+    man.to_csv(tmp, index=False)
+    os.replace(tmp, manifest_file)
+
+def _read_rows(fname):
+    # Output rows keyed by rounded (l,b), and the column names; ({}, None) if missing or empty
+    if not os.path.isfile(fname) or os.path.getsize(fname)==0:
+        return {}, None
+    try:
+        prev = pd.read_csv(fname)
+    except pd.errors.EmptyDataError:
+        return {}, None
+    return {(round(r[0],3), round(r[1],3)): list(r) for r in prev.itertuples(index=False)}, list(prev.columns)
+
+def run_rates(chips, out_file, n_proc=None, lens_pattern=lens_pattern, src_pattern=src_pattern,
+              only_changed=True, log_file=None, **mulens_kwargs):
+    """
+    Calculate microlensing rates for every chip.
+    inputs:
+        chips: DataFrame with GLON, GLAT columns, one row per chip
+        out_file: output table (csv); one row per chip, NaN for failed chips
+        n_proc: number of worker processes (default: all cores)
+        lens_pattern, src_pattern: format strings for the lens/src catalog of (l,b)
+        only_changed: if True, keep rows from a previous (or interrupted) run for
+            chips which succeeded with unchanged inputs and mulens_kwargs;
+            recompute the rest
+        log_file: per-chip timing/memory log (JSON lines, see instrument);
+            default out_file+'.instrument.jsonl'
+        mulens_kwargs: passed on to mulens_stats (e.g. nsd=True, tE_range=[0,300])
+    output:
+        DataFrame of the output table
+    """
+    manifest_file = out_file+'.inputs.csv'
+    stream_file = out_file+'.partial'
+    run_id = instrument.set_log(log_file if log_file is not None else out_file+'.instrument.jsonl')
+    khash = kwargs_hash(mulens_kwargs)
+    jobs, sigs = [], {}
+    for chip in range(len(chips)):
+        l, b = float(chips['GLON'].iloc[chip]), float(chips['GLAT'].iloc[chip])
+        f_lens, f_src = lens_pattern.format(l=l, b=b), src_pattern.format(l=l, b=b)
+        sigs[chip] = (l, b, file_signature(f_lens), file_signature(f_src), khash)
+        jobs.append((chip, l, b, f_lens, f_src, mulens_kwargs))
+
+    # Rows from previous runs (the finished table, then rows streamed by an interrupted
+    # run) are reused only if the chip succeeded with the same inputs and kwargs
+    rows, output_cols = {}, None
+    old = read_manifest(manifest_file)
+    if only_changed and len(old)>0:
+        prev_rows, output_cols = _read_rows(out_file)
+        part_rows, part_cols = _read_rows(stream_file)
+        if output_cols is None or part_cols==output_cols:
+            prev_rows.update(part_rows)
+            output_cols = output_cols or part_cols
+        for rec in old.itertuples(index=False):
+            if rec.status!='ok' or rec.chip not in sigs:
+                continue
+            l, b, lens_sig, src_sig, chip_hash = sigs[rec.chip]
+            key = (round(l,3), round(b,3))
+            if (lens_sig, src_sig, chip_hash)==(rec.lens_sig, rec.src_sig, rec.kwargs_hash) \
+                    and key in prev_rows:
+                rows[rec.chip] = prev_rows[key]
+    todo = [job for job in jobs if job[0] not in rows]
+    print(f'{len(todo)} chips to calculate, {len(rows)} unchanged', flush=True)
+
+    status = {chip: ('ok', '') for chip in rows}
+    if len(todo)>0:
+        if n_proc is None:
+            n_proc = os.cpu_count()
+        n_proc = max(1, min(n_proc, len(todo)))
+        # Reused rows go first into a fresh stream file, so it always matches the manifest
+        with open(stream_file, 'w') as f_out:
+            if output_cols is not None and len(rows)>0:
+                f_out.write(','.join(output_cols)+'\n')
+                for chip in sorted(rows):
+                    f_out.write(','.join(str(x) for x in rows[chip])+'\n')
+        # Rewrite the manifest (one record per chip, current columns) before appending to it
+        _write_manifest(manifest_file, old)
+        with open(stream_file, 'a') as f_out, open(manifest_file, 'a', newline='') as f_man, \
+             ProcessPoolExecutor(n_proc) as pool:
+            man_writer = csv.writer(f_man)
+            done_futures = set()
+            futures = [pool.submit(_rate_job, job) for job in todo]
+            for fut in as_completed(futures):
+                try:
+                    chip, dat, cols, reason = fut.result()
+                except BrokenProcessPool:
+                    # A worker died (e.g. killed for memory): every chip still pending is lost
+                    lost = [job[0] for job, f in zip(todo, futures) if f not in done_futures]
+                    reason = 'worker process died before the chip finished'
+                    for chip in lost:
+                        status[chip] = ('failed', reason)
+                        man_writer.writerow([chip, *sigs[chip], *status[chip]])
+                    f_man.flush()
+                    print(f'Worker process died; {len(lost)} chips lost:', *lost, flush=True)
+                    raise
+                done_futures.add(fut)
+                l, b = sigs[chip][:2]
+                if reason is None:
+                    if output_cols is None:
+                        output_cols = cols
+                    if f_out.tell()==0:
+                        f_out.write(','.join(output_cols)+'\n')
+                    f_out.write(','.join(str(x) for x in dat)+'\n')
+                    f_out.flush()
+                    rows[chip] = dat
+                    status[chip] = ('ok', '')
+                    print(chip, *dat[:4], flush=True)
+                else:
+                    status[chip] = ('failed', reason)
+                    print(chip, l, b, 'FAILED:', reason, flush=True)
+                # The manifest record follows its output row, so an 'ok' chip always has one
+                man_writer.writerow([chip, *sigs[chip], *status[chip]])
+                f_man.flush()
+
+    man = pd.DataFrame([[chip, *sigs[chip], *status[chip]] for chip in sorted(status)],
+                       columns=manifest_cols)
+    _write_manifest(manifest_file, man)
+    n_failed = int(np.sum(man['status']!='ok'))
+    if n_failed>0:
+        print(f'{n_failed} chips failed, see {manifest_file}', flush=True)
+    if output_cols is None:
+        print('No chips succeeded; no output table written', flush=True)
+        return None
+
+    # Failed chips keep their position in the table, with l, b and NaN values
+    data_list = []
+    for chip in range(len(chips)):
+        if chip in rows:
+            data_list.append(rows[chip])
+        else:
+            data_list.append(list(sigs[chip][:2])+[np.nan]*(len(output_cols)-2))
+    with instrument.span('write_output') as sp:
+        sp.rows = len(data_list)
+        output = pd.DataFrame(data=data_list, columns=output_cols)
+        output.to_csv(out_file, index=False)
+    if os.path.isfile(stream_file):
+        os.remove(stream_file)
+    instrument.summary(run=run_id)
+    return output
@@ -0,0 +1,190 @@
+"""
+Benchmarks of the catalog processing and evaluation stages on synthetic catalogs.
+
+Synthetic bulge-like catalogs of a given size are drawn at a fixed surface
+density (so larger catalogs cover a larger area, as real fields do): a
+power-law luminosity function with a red clump, bulge-like colours and
+proper motions. Each stage is run once under tracemalloc for its peak
+memory and then timed (wall and CPU) over a few untraced repeats.
+Neither SynthPop, its data files nor the network are needed.
+
+Current stages are:
+    blending: blending.blend_catalog in two filters
+    histograms: evals.histograms.CMDAccumulator, fed in chunks
+    subfields: ogle_geometry.assign_subfields for every star
+    catalog_io: catalog_store.write_field and a magnitude-cut read_field
+    rate_aggregation: evals.mulensstats.chips_to_fields on a synthetic
+        per-chip rate table (one chip per 100 stars), with bootstrap errors
+
+Usage:
+    python benchmarks.py --sizes 1e4 1e5 1e6 1e7 --out outputfiles/benchmarks.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+import pandas as pd
+import blending
+import catalog_store
+import ogle_geometry
+from evals import histograms
+from evals import mulensstats
+
+field_l, field_b = 1.0, -3.0
+# Stars per deg^2 brighter than mag_lim in I, typical of a low-extinction bulge field
+star_density = 3e6
+mag_lim = 22.0
+
+def synthetic_catalog(n_stars, seed=0, density=star_density, l0=field_l, b0=field_b):
+    """
+    Draw a bulge-like catalog of n_stars in a square field of the given density.
+    output:
+        DataFrame with l, b, Bessell_I, Bessell_V, VISTA_Ks, mul, mub, pop
+    """
+    rng = np.random.default_rng(seed)
+    n = int(n_stars)
+    side = np.sqrt(n/density)
+    l = l0 + (rng.random(n)-0.5)*side
+    b = b0 + (rng.random(n)-0.5)*side
+    # Luminosity function dN/dI ~ 10**(0.3 I) below the limit, plus a red clump at I~15.5
+    alpha = 0.3*np.log(10)
+    lo, hi = 12.0, mag_lim
+    u = rng.random(n)
+    mag_i = np.log(np.exp(alpha*lo) + u*(np.exp(alpha*hi)-np.exp(alpha*lo)))/alpha
+    clump = rng.random(n)<0.05
+    mag_i[clump] = rng.normal(15.5, 0.3, np.sum(clump))
+    vi = np.where(clump, rng.normal(2.0, 0.1, n), 1.2 + 0.05*(mag_i-14) + rng.normal(0, 0.15, n))
+    ik = np.where(clump, rng.normal(2.2, 0.1, n), 1.6 + rng.normal(0, 0.2, n))
+    pop = rng.choice(np.arange(5), size=n, p=[0.05, 0.25, 0.05, 0.6, 0.05])
+    mul = rng.normal(-6.0, 3.0, n)
+    mub = rng.normal(-0.2, 2.8, n)
+    return pd.DataFrame({'l':l, 'b':b, 'Bessell_I':mag_i, 'Bessell_V':mag_i+vi,
+                         'VISTA_Ks':mag_i-ik, 'mul':mul, 'mub':mub, 'pop':pop})
+
+def synthetic_geometry(l0=field_l, b0=field_b):
+    """
+    OGLE-IV geometry index for a 3x3 grid of fields centred on (l0, b0),
+    so subfield assignment runs without the Mroz et al. 2019 tables.
+    """
+    dl, db = np.meshgrid(np.arange(-1, 2)*1.4, np.arange(-1, 2)*1.2)
+    ra0, dec0 = ogle_geometry.galactic_to_equatorial(l0+dl.ravel(), b0+db.ravel())
+    names = [f'BLG9{i:02d}' for i in range(len(ra0))]
+    return ogle_geometry.build_index(names, ra0, dec0)
+
+def _bench_blending(cat, ctx):
+    out = blending.blend_catalog(cat, ['Bessell_I', 'Bessell_V'], sort_filt='Bessell_I')
+    return len(out)
+
+def _bench_histograms(cat, ctx):
+    acc = histograms.CMDAccumulator(np.arange(12, 22.01, 0.1), np.arange(0, 4.01, 0.05), (12, 22), (0, 4))
+    chunk = 1000000
+    for start in range(0, len(cat), chunk):
+        acc.add(cat['Bessell_I'].to_numpy()[start:start+chunk], cat['Bessell_V'].to_numpy()[start:start+chunk])
+    return acc.n_stars
+
+def _bench_subfields(cat, ctx):
+    codes = ogle_geometry.assign_subfields(cat['l'].to_numpy(), cat['b'].to_numpy(), ctx['geometry'])
+    return int(np.sum(codes>=0))
+
+def _bench_catalog_io(cat, ctx):
+    store_dir = os.path.join(ctx['tmp_dir'], 'store')
+    catalog_store.write_field(cat, field_l, field_b, store_dir, sort_by='Bessell_I')
+    dat = catalog_store.read_field(field_l, field_b, store_dir, columns=['Bessell_I', 'Bessell_V', 'pop'],
+                                   where={'Bessell_I':(None, 18)})
+    shutil.rmtree(store_dir)
+    return len(dat)
+
+def _bench_rate_aggregation(cat, ctx):
+    # One batch_rates chip per 100 stars, spread over OGLE-like fields of 32 chips
+    rng = np.random.default_rng(1)
+    n = max(len(cat)//100, 32)
+    names = np.char.add(np.char.add('BLG', (500+np.arange(n)//32).astype(str)),
+                        np.char.add('.', np.char.zfill((np.arange(n)%32+1).astype(str), 2)))
+    chips = pd.DataFrame({'eventrate_area':rng.exponential(1e-2, n), 'eventrate_source':rng.exponential(1e-5, n),
+                          'avg_tau':rng.exponential(1e-6, n), 'avg_t':rng.lognormal(np.log(20), 0.3, n),
+                          'avg_logt':rng.normal(1.3, 0.1, n), 'n_source':rng.poisson(5000, n),
+                          'sa_source':np.full(n, 1e-4)})
+    fields = mulensstats.chips_to_fields(chips, names, weighting='sources', n_boot=100)
+    return len(fields)
+
+stages = {'blending':_bench_blending, 'histograms':_bench_histograms, 'subfields':_bench_subfields,
+          'catalog_io':_bench_catalog_io, 'rate_aggregation':_bench_rate_aggregation}
+
+def run_stage(func, cat, ctx, repeat=3):
+    """
+    Run one benchmark stage: once under tracemalloc (peak Python/NumPy memory),
+    then repeat untraced runs for the timings.
+    output:
+        dictionary of timings (best and all wall times, best CPU time), peak memory and output rows
+    """
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    rows = func(cat, ctx)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    walls, cpus = [], []
+    for _ in range(repeat):
+        t0, c0 = time.perf_counter(), time.process_time()
+        func(cat, ctx)
+        walls.append(time.perf_counter()-t0)
+        cpus.append(time.process_time()-c0)
+    return {'wall_s':min(walls), 'wall_all_s':walls, 'cpu_s':min(cpus), 'peak_mb':peak/2**20, 'rows_out':rows}
+
+def run_benchmarks(sizes=[1e4, 1e5, 1e6, 1e7], use_stages=None, repeat=3, seed=0, out_file=None):
+    """
+    Benchmark every stage at every catalog size.
+    inputs:
+        sizes: catalog sizes (number of stars)
+        use_stages: stage names to run (default: all)
+        repeat: number of timed repeats per stage
+        seed: random seed of the synthetic catalogs
+        out_file: optional JSON output file
+    output:
+        dictionary with run metadata and a list of results
+    """
+    if use_stages is None:
+        use_stages = list(stages)
+    meta = {'date':time.strftime('%Y-%m-%dT%H:%M:%S'), 'python':sys.version.split()[0],
+            'numpy':np.__version__, 'pandas':pd.__version__, 'platform':platform.platform(),
+            'cpu_count':os.cpu_count(), 'star_density_deg2':star_density, 'repeat':repeat, 'seed':seed}
+    results = []
+    tmp_dir = tempfile.mkdtemp(prefix='synthpop_bench_')
+    try:
+        ctx = {'geometry':synthetic_geometry(), 'tmp_dir':tmp_dir}
+        for size in sizes:
+            t0 = time.perf_counter()
+            cat = synthetic_catalog(size, seed=seed)
+            print(f'{len(cat)} stars generated in {time.perf_counter()-t0:.2f} s', flush=True)
+            for name in use_stages:
+                res = {'stage':name, 'n_stars':len(cat), **run_stage(stages[name], cat, ctx, repeat)}
+                print(f"  {name:18s} {res['wall_s']:9.3f} s  {res['cpu_s']:9.3f} s cpu  "
+                      f"{res['peak_mb']:9.1f} MB", flush=True)
+                results.append(res)
+            del cat
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    output = {'meta':meta, 'results':results}
+    if out_file is not None:
+        out_dir = os.path.dirname(out_file)
+        if out_dir:
+            os.makedirs(out_dir, exist_ok=True)
+        with open(out_file, 'w') as f:
+            json.dump(output, f, indent=1)
+    return output
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark catalog processing stages on synthetic catalogs')
+    parser.add_argument('--sizes', type=float, nargs='+', default=[1e4, 1e5, 1e6, 1e7])
+    parser.add_argument('--stages', nargs='+', choices=list(stages), default=None)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default='outputfiles/benchmarks.json')
+    args = parser.parse_args()
+    run_benchmarks(args.sizes, args.stages, args.repeat, args.seed, args.out)
@@ -0,0 +1,159 @@
+"""
+On-disk cache of blended model catalogs.
+
+Each blended product is keyed by a content hash of the columns of the source
+catalog that the blend depends on plus the blend parameters (filters,
+blending radius, ranking filter, magnitude cuts, kept columns), so changing
+any parameter or regenerating the catalog gives a new entry instead of
+silently reusing a stale one. Entries are stored as uncompressed .npz files
+(one array per column) next to a JSON index, and the least recently used
+entries are evicted once the cache exceeds max_bytes.
+
+Usage:
+    tab_bl = cached_blend_catalog(sptab, ['VISTA_J','VISTA_H','VISTA_Ks'],
+                                  blend_rad=0.36/3600, sort_filt='VISTA_Ks',
+                                  keep_cols=['pop','mul','mub'])
+"""
+
+import os
+import json
+import time
+import hashlib
+import numpy as np
+import pandas as pd
+import blending
+
+# Bumped whenever blending results change, so stale cached blends are not reused
+cache_version = 2
+
+def catalog_hash(cat, columns):
+    """
+    Content hash of the given columns of a catalog.
+    """
+    h = hashlib.sha1()
+    for col in columns:
+        arr = np.ascontiguousarray(np.asarray(cat[col]))
+        h.update(str(col).encode())
+        h.update(str(arr.dtype).encode())
+        h.update(str(arr.shape).encode())
+        if arr.dtype==object:
+            h.update(pd.util.hash_array(arr).tobytes())
+        else:
+            h.update(arr.tobytes())
+    return h.hexdigest()
+
+def blend_key(cat_hash, params):
+    """
+    Cache key combining the source catalog hash and the blend parameters.
+    """
+    desc = json.dumps({'catalog':cat_hash, 'version':cache_version, **params}, sort_keys=True)
+    return hashlib.sha1(desc.encode()).hexdigest()
+
+def _read_index(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, 'index.json')) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def _write_index(cache_dir, index):
+    tmp = os.path.join(cache_dir, f'index.json.{os.getpid()}.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmp, os.path.join(cache_dir, 'index.json'))
+
+def _entry_file(cache_dir, key):
+    return os.path.join(cache_dir, key+'.npz')
+
+def load_entry(key, cache_dir='outputfiles/blend_cache'):
+    """
+    Return the cached DataFrame for a key, or None if it is not cached.
+    """
+    fname = _entry_file(cache_dir, key)
+    if not os.path.isfile(fname):
+        return None
+    with np.load(fname, allow_pickle=False) as npz:
+        cols = list(npz['__columns__'])
+        out = pd.DataFrame({col: npz['c'+str(i)] for i,col in enumerate(cols)})
+    index = _read_index(cache_dir)
+    if key in index:
+        index[key]['atime'] = time.time()
+        _write_index(cache_dir, index)
+    return out
+
+def store_entry(key, df, params, cache_dir='outputfiles/blend_cache', max_bytes=20*2**30):
+    """
+    Write a DataFrame to the cache (atomically) and evict old entries past max_bytes.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    fname = _entry_file(cache_dir, key)
+    tmp = fname[:-4]+f'.{os.getpid()}.tmp.npz'
+    arrays = {}
+    for i,col in enumerate(df.columns):
+        arr = df[col].to_numpy()
+        arrays['c'+str(i)] = arr.astype(str) if arr.dtype==object else arr
+    np.savez(tmp, __columns__=np.array([str(col) for col in df.columns]), **arrays)
+    os.replace(tmp, fname)
+    index = _read_index(cache_dir)
+    index[key] = {'params':params, 'nbytes':os.path.getsize(fname), 'atime':time.time()}
+    evict(index, cache_dir, max_bytes, keep=key)
+    _write_index(cache_dir, index)
+
+def evict(index, cache_dir, max_bytes, keep=None):
+    """
+    Remove least recently used entries from the cache (and index, in place)
+    until the total size is below max_bytes.
+    """
+    total = sum(entry['nbytes'] for entry in index.values())
+    for key in sorted(index, key=lambda k: index[k]['atime']):
+        if total<=max_bytes:
+            break
+        if key==keep:
+            continue
+        try:
+            os.remove(_entry_file(cache_dir, key))
+        except FileNotFoundError:
+            pass
+        total -= index.pop(key)['nbytes']
+
+def cached_blend_catalog(cat, filters, blend_rad=0.45/2/3600, sort_filt=None, maglims=None,
+                         keep_cols=None, cache_dir='outputfiles/blend_cache', max_bytes=20*2**30):
+    """
+    Blend a catalog with blending.blend_catalog, reusing a cached result when
+    the same catalog has already been blended with the same parameters.
+    inputs:
+        cat: DataFrame with l, b, each filter and any keep_cols (unlike
+            blending.blend_catalog, a dictionary of arrays is not accepted)
+        filters: list of magnitude columns to blend
+        blend_rad: blending radius (deg)
+        sort_filt: filter used to rank stars by brightness (default: filters[0])
+        maglims: optional {filter: faint limit}; fainter stars are dropped before blending
+        keep_cols: other columns to copy from each blend's centre star
+        cache_dir: location of the cache
+        max_bytes: cache size limit
+    output:
+        DataFrame of blended stars (see blending.blend_catalog)
+    """
+    if not isinstance(cat, pd.DataFrame):
+        raise TypeError(f'cached_blend_catalog needs a DataFrame, not {type(cat).__name__}')
+    if sort_filt is None:
+        sort_filt = filters[0]
+    keep_cols = list(keep_cols) if keep_cols is not None else []
+    maglims = dict(maglims) if maglims is not None else {}
+    params = {'filters':list(filters), 'blend_rad':float(blend_rad), 'sort_filt':sort_filt,
+              'maglims':{k:float(v) for k,v in maglims.items()}, 'keep_cols':keep_cols}
+    used = list(dict.fromkeys(['l','b', sort_filt, *filters, *maglims, *keep_cols]))
+    key = blend_key(catalog_hash(cat, used), params)
+    out = load_entry(key, cache_dir)
+    if out is not None:
+        return out
+
+    sel = np.ones(len(cat), dtype=bool)
+    for filt, lim in maglims.items():
+        sel &= np.asarray(cat[filt], dtype=float)<lim
+    sub = cat[sel] if not np.all(sel) else cat
+    out = blending.blend_catalog(sub, filters, blend_rad=blend_rad, sort_filt=sort_filt,
+                                 keep_cols=keep_cols)
+    out['orig_idx'] = np.flatnonzero(sel)[out['orig_idx'].to_numpy()]
+    store_entry(key, out, params, cache_dir, max_bytes)
+    return out
@@ -0,0 +1,189 @@
+"""
+Methods to blend stars in model catalogs that fall within a blending
+radius of each other, brightest star first.
+
+The result is that of the sequential rule: going from the brightest star
+down, each star not yet in a group becomes a group centre and takes all
+ungrouped stars within the blending radius. Close pairs are found with a
+spatial index, and the centres are then decided in vectorized rounds: every
+undecided star with no brighter undecided neighbour becomes a centre, and
+its undecided neighbours are marked as members. Only once all centres are
+known does each member join its brightest neighbouring centre (a brighter
+centre may be decided in a later round than a fainter one). Group fluxes
+for any number of filters are summed with np.add.reduceat.
+
+Large catalogs have their close pairs found in strips of Galactic latitude
+(each with a halo of one blending radius, each pair kept by the strip
+holding its lower-latitude star), so the spatial index is bounded by
+chunk_size. The rounds then run on the pair list of the whole catalog, so
+the groups do not depend on chunk_size.
+
+Current options are:
+    find_blend_groups(l, b, mags)
+    blend_fluxes(groups, mags)
+    blend_catalog(cat, filters)
+    count_blends(cat, filt)
+"""
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+def magsum(mags, axis=None):
+    """
+    Combined magnitude of a set of magnitudes.
+    """
+    return -2.5*np.log10(np.nansum(10**(-0.4*np.asarray(mags, dtype=float)), axis=axis))
+
+def _close_pairs(x, y, blend_rad, chunk_size):
+    """
+    All pairs of stars closer than blend_rad, found in strips of y with at
+    most chunk_size stars (plus halo) per spatial index.
+    Returns the two index arrays of the pairs.
+    """
+    n = len(x)
+    by = np.argsort(y, kind='stable')
+    ys = y[by]
+    p_all, q_all = [], []
+    for start in range(0, n, chunk_size):
+        stop = min(start+chunk_size, n)
+        # Halo: stars up to one blending radius above the strip
+        i1 = np.searchsorted(ys, ys[stop-1]+blend_rad, side='right')
+        dom = by[start:i1]
+        pairs = cKDTree(np.column_stack([x[dom], y[dom]])).query_pairs(blend_rad, output_type='ndarray')
+        # A pair belongs to the strip of its first star in latitude order
+        own = np.minimum(pairs[:,0], pairs[:,1]) < stop-start
+        p_all.append(dom[pairs[own,0]])
+        q_all.append(dom[pairs[own,1]])
+        del pairs
+    if n==0:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    return np.concatenate(p_all), np.concatenate(q_all)
+
+def _group_pairs(n, lo, hi):
+    """
+    Brightest-first grouping given the close pairs in brightness rank (lo the
+    brighter star of each pair). Returns the rank of each star's group centre.
+    """
+    # 0: undecided, 1: centre, 2: member
+    state = np.zeros(n, dtype=np.int8)
+    plo, phi = lo, hi
+    while len(plo)>0:
+        # Centres: undecided stars with no brighter undecided neighbour
+        has_brighter = np.zeros(n, dtype=bool)
+        has_brighter[phi] = True
+        new = (state==0) & ~has_brighter
+        state[new] = 1
+        # Undecided neighbours of new centres can no longer be centres
+        state[phi[new[plo]]] = 2
+        # Only pairs between still undecided stars matter for the next round
+        keep = (state[plo]==0) & (state[phi]==0)
+        plo, phi = plo[keep], phi[keep]
+    state[state==0] = 1
+    # Each member joins its brightest neighbouring centre
+    grp = np.arange(n, dtype=np.int64)
+    sel = (state[lo]==1) & (state[hi]==2)
+    memb = np.full(n, n, dtype=np.int64)
+    np.minimum.at(memb, hi[sel], lo[sel])
+    is_memb = state==2
+    grp[is_memb] = memb[is_memb]
+    return grp
+
+def find_blend_groups(l, b, mags, blend_rad=0.45/2/3600, chunk_size=1000000):
+    """
+    Assign every star to a blend group, brightest star first.
+    inputs:
+        l, b: Galactic coordinates of the stars (deg)
+        mags: magnitudes used to rank stars by brightness (NaN ranks faintest)
+        blend_rad: blending radius (deg)
+        chunk_size: maximum number of stars (plus halo) in one spatial index;
+            the result does not depend on it
+    output:
+        array giving, for each star, the index of its group's centre star
+    """
+    l = np.asarray(l, dtype=float)
+    b = np.asarray(b, dtype=float)
+    mags = np.asarray(mags, dtype=float)
+    n = len(l)
+    lw = l - 360*(l>180)
+    x = (lw-np.median(lw))*np.cos(b*np.pi/180) if n>0 else lw
+    p, q = _close_pairs(x, b, blend_rad, chunk_size)
+    order = np.argsort(mags, kind='stable')
+    rank = np.empty(n, dtype=np.int64)
+    rank[order] = np.arange(n)
+    i, j = rank[p], rank[q]
+    del p, q
+    grp = _group_pairs(n, np.minimum(i, j), np.maximum(i, j))
+    return order[grp[rank]]
+
+def blend_fluxes(groups, mags):
+    """
+    Sum fluxes within blend groups.
+    inputs:
+        groups: group centre index for each star, from find_blend_groups
+        mags: magnitudes, shape (n_stars,) or (n_stars, n_filters); NaN adds no flux
+    output:
+        centres: index of each group's centre star
+        blend_mags: blended magnitudes, shape (n_groups,) or (n_groups, n_filters)
+        n_blend: number of stars in each group
+    """
+    groups = np.asarray(groups)
+    order = np.argsort(groups, kind='stable')
+    gs = groups[order]
+    starts = np.flatnonzero(np.r_[True, gs[1:]!=gs[:-1]])
+    flux = np.nan_to_num(10**(-0.4*np.asarray(mags, dtype=float)[order]), nan=0.0)
+    fsum = np.add.reduceat(flux, starts, axis=0)
+    with np.errstate(divide='ignore'):
+        blend_mags = np.where(fsum>0, -2.5*np.log10(fsum), np.nan)
+    n_blend = np.diff(np.r_[starts, len(gs)])
+    return gs[starts], blend_mags, n_blend
+
+def blend_catalog(cat, filters, blend_rad=0.45/2/3600, sort_filt=None, keep_cols=None,
+                  chunk_size=1000000):
+    """
+    Blend a catalog in several filters at once.
+    inputs:
+        cat: DataFrame (or dictionary of arrays) with l, b and each filter
+        filters: list of magnitude columns to blend
+        blend_rad: blending radius (deg)
+        sort_filt: filter used to rank stars by brightness (default: filters[0])
+        keep_cols: other columns (e.g. pop, mul, mub) to copy from each centre star
+        chunk_size: maximum number of stars (plus halo) handled at once
+    output:
+        DataFrame with one row per blend: the centre star's index (orig_idx) and
+        l, b, the blended magnitudes in each filter, any keep_cols, and the
+        number of stars blended
+    """
+    if sort_filt is None:
+        sort_filt = filters[0]
+    l, b = np.asarray(cat['l'], dtype=float), np.asarray(cat['b'], dtype=float)
+    groups = find_blend_groups(l, b, cat[sort_filt], blend_rad=blend_rad, chunk_size=chunk_size)
+    mags = np.column_stack([np.asarray(cat[filt], dtype=float) for filt in filters])
+    centres, blend_mags, n_blend = blend_fluxes(groups, mags)
+    out = pd.DataFrame(blend_mags, columns=filters)
+    out.insert(0, 'orig_idx', centres)
+    out.insert(1, 'l', l[centres])
+    out.insert(2, 'b', b[centres])
+    if keep_cols is not None:
+        for col in keep_cols:
+            out[col] = np.asarray(cat[col])[centres]
+    out['n_blend'] = n_blend
+    return out
+
+def count_blends(cat, filt, maglim=19, maglim_hi=11.5, blend_rad=0.45/2/3600, chunk_size=1000000):
+    """
+    Star counts before and after blending in one filter.
+    inputs:
+        cat: DataFrame with l, b and filt columns; stars with NaN in filt are dropped
+        filt: magnitude column
+        maglim, maglim_hi: faint and bright magnitude limits of the unblended count
+        blend_rad: blending radius (deg)
+    output:
+        number of unblended stars with maglim_hi<mag<maglim,
+        number of blends with blended mag<maglim
+    """
+    cat = cat[~np.isnan(cat[filt])]
+    mags = np.asarray(cat[filt], dtype=float)
+    groups = find_blend_groups(cat['l'], cat['b'], mags, blend_rad=blend_rad, chunk_size=chunk_size)
+    _, blend_mags, _ = blend_fluxes(groups, mags)
+    return int(np.sum((mags<maglim) & (mags>maglim_hi))), int(np.sum(blend_mags<maglim))
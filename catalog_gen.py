@@ -1,37 +1,114 @@
-import synthpop as sp
+import os
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
-from astropy.table import Table
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+import instrument
+import field_driver
 
-def ogle_starcounts():
+# SynthPop settings for the OGLE subfield star counts
+starcount_kwargs = dict(default_config='huston2025_defaults.synthpop_conf',
+                        model_name="Huston2025", name_for_output='src_count',
+                        maglim=['Bessell_I', 21,"remove"], output_location="outputfiles/ogle",
+                        chosen_bands = ['Bessell_I', 'Bessell_V'],
+                        post_processing_kwargs = [{"name": "ProcessDarkCompactObjects","remove": True}],
+                        extinction_map_kwargs={"name":"surot"},
+                        skip_lowmass_stars=True)
+
+def cumulative_counts(mags, maglims):
+    """
+    Number of stars brighter than (mag<) each magnitude limit, from a single sort.
+    """
+    mags = np.sort(np.asarray(mags, dtype=float))
+    return np.searchsorted(mags, np.asarray(maglims, dtype=float), side='left')
+
+def reuse_groups(lbs, tol):
+    """
+    Group positions closer than tol (deg, in l and b) to each other, with
+    chains of close pairs joined into one group (connected components of
+    the pairs found with a KD-tree).
+    inputs:
+        lbs: (n, 2) array of l, b
+        tol: linking distance (deg)
+    output:
+        group index of each position, numbered in order of first appearance
+    """
+    pairs = cKDTree(lbs).query_pairs(tol, output_type='ndarray')
+    graph = coo_matrix((np.ones(len(pairs)), (pairs[:,0], pairs[:,1])), shape=(len(lbs), len(lbs)))
+    return connected_components(graph, directed=False)[1]
+
+def _count_field(job):
+    # Runs in a worker: only the counts leave the process, not the catalog
+    key, field, l, b, sa_deg, maglims, band = job
+    mod = field_driver.get_model('count')
+    with instrument.span('process_location', field=field, l=l, b=b) as span:
+        dat, _ = mod.process_location(l, b, solid_angle=sa_deg, solid_angle_unit='deg^2', save_data=False)
+        counts = cumulative_counts(dat[band].to_numpy(), maglims)
+        span.rows = len(dat)
+    return key, counts
+
+def ogle_starcounts(maglims=[21, 18], sa_deg=0.004, n_proc=None, reuse_tol=None, band='Bessell_I',
+                    out_file='outputfiles/ogle_sim_surfdens.csv',
+                    log_file='outputfiles/ogle/instrument.jsonl'):
+    """
+    Model star counts for the OGLE-IV subfields in the map region.
+    inputs:
+        maglims: magnitude limits in band; counts of stars brighter than each
+            are taken from one catalog per position
+        sa_deg: solid angle of each catalog (deg^2)
+        n_proc: number of worker processes (default: all cores)
+        reuse_tol: subfields linked by separations below reuse_tol (deg) share
+            one catalog at their mean position (see reuse_groups; default: only
+            coincident positions, to 0.001 deg, are shared)
+        band: magnitude column the limits apply to
+        out_file: output csv
+        log_file: timing log (see instrument)
+    output:
+        DataFrame with field, l, b, n{lim} and sigma{lim} (stars/arcmin^2) for each limit
+    """
+    import fetch_data
+    run_id = instrument.set_log(log_file)
     # Load needed OGLE data
-    ogle_surfdens = Table.read('data/apjsab426b/apjsab426bt5_mrt.txt', format="ascii.cds").to_pandas(index='field')
+    ogle_surfdens = fetch_data.ogle_mroz2019()[0]
     subfs_inmap = ogle_surfdens[(np.abs(ogle_surfdens.GLON)<10) & (ogle_surfdens.GLAT<5) & (ogle_surfdens.GLAT>-10)]
     ogle_subf_lbs = subfs_inmap[['GLON','GLAT']].to_numpy()
 
-    # Set up SynthPop model
-    mod = sp.SynthPop(default_config='huston2025_defaults.synthpop_conf',
-                              model_name="Huston2025", name_for_output='src_count',
-                             maglim=['Bessell_I', 21,"remove"], output_location="outputfiles/ogle",
-                              chosen_bands = ['Bessell_I', 'Bessell_V'],
-                             post_processing_kwargs = [{"name": "ProcessDarkCompactObjects","remove": True}], 
-                             extinction_map_kwargs={"name":"surot"},
-                             skip_lowmass_stars=True)
-    mod.init_populations()
+    # Group subfields sharing a position (or within reuse_tol); each group is generated once
+    group = reuse_groups(ogle_subf_lbs, reuse_tol if reuse_tol else 1e-3)
+    n_groups = group.max()+1
+    n_members = np.bincount(group, minlength=n_groups)
+    group_l = np.bincount(group, weights=ogle_subf_lbs[:,0], minlength=n_groups)/n_members
+    group_b = np.bincount(group, weights=ogle_subf_lbs[:,1], minlength=n_groups)/n_members
+    first_field = subfs_inmap.index.to_numpy()[np.unique(group, return_index=True)[1]]
+    jobs = [(j, str(first_field[j]), float(group_l[j]), float(group_b[j]), sa_deg, list(maglims), band)
+            for j in range(n_groups)]
+    print(f'{len(ogle_subf_lbs)} subfields, {n_groups} catalogs to generate', flush=True)
 
     # Get stellar densities by subfield
-    n21s = np.zeros(len(ogle_subf_lbs))
-    n18s = np.zeros(len(ogle_subf_lbs))
-    sa_deg = 0.004
-    for i, lb in enumerate(ogle_subf_lbs):
-        dat, _ = mod.process_location(*lb, solid_angle=sa_deg, solid_angle_unit='deg^2', save_data=False)
-        n21s[i] = len(dat)
-        n18s[i] = len(dat[dat.Bessell_I<18])
+    counts = np.zeros((n_groups, len(maglims)))
+    if n_proc is None:
+        n_proc = os.cpu_count()
+    n_proc = max(1, min(n_proc, n_groups))
+    with ProcessPoolExecutor(n_proc, initializer=field_driver.init_worker,
+                             initargs=({'count':starcount_kwargs}, None)) as pool:
+        for n, (j, cts) in enumerate(field_driver.imap_unordered(pool, _count_field, jobs)):
+            counts[j] = cts
+            print(n, *jobs[j][1:4], *cts, flush=True)
+    counts = counts[group]
 
     # Save result
-    df = pd.DataFrame({'field':subfs_inmap.index.to_numpy(), 'l':ogle_subf_lbs[:,0], 'b':ogle_subf_lbs[:,1],
-                      'n21':n21s, 'n18':n18s, 'sigma21':n21s/sa_deg/3600, 'sigma18':n18s/sa_deg/3600})
-    df.to_csv('outputfiles/ogle_sim_surfdens.csv', index=False)
+    df = pd.DataFrame({'field':subfs_inmap.index.to_numpy(), 'l':ogle_subf_lbs[:,0], 'b':ogle_subf_lbs[:,1]})
+    for i, lim in enumerate(maglims):
+        df[f'n{lim:g}'] = counts[:,i]
+    for i, lim in enumerate(maglims):
+        df[f'sigma{lim:g}'] = counts[:,i]/sa_deg/3600
+    with instrument.span('write_output') as span:
+        df.to_csv(out_file, index=False)
+        span.rows = len(df)
+    instrument.summary(log_file, run=run_id)
     return df
-    
-ogle_starcounts()
\ No newline at end of file
+
+if __name__ == '__main__':
+    ogle_starcounts()
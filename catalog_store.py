@@ -0,0 +1,226 @@
+"""
+Column-oriented, memory-mappable store for SynthPop model catalogs.
+
+Model outputs (per-field csv or h5 files) are converted once into one
+directory per field (l,b), holding one .npy file per column and a meta.json
+with the row count, column dtypes and per-row-group min/max ("zone maps").
+Reads memory-map only the requested columns, and magnitude predicates are
+pushed down: row groups whose min/max cannot satisfy the cut are skipped, and
+only the predicate columns are touched to build the row selection. Sorting
+rows by a magnitude column at conversion time (sort_by) makes magnitude cuts
+read a single contiguous block.
+
+Usage:
+    convert_outputs('outputfiles/hst_bt/Huston2025_l*.csv', 'outputfiles/hst_bt/store',
+                    sort_by='WFC3_UVIS_F814W')
+    dat = read_field(0.25, -2.15, 'outputfiles/hst_bt/store',
+                     columns=['WFC3_UVIS_F814W', 'pop'], where={'WFC3_UVIS_F814W': (None, 21)})
+"""
+
+import os
+import re
+import glob
+import json
+import numpy as np
+import pandas as pd
+
+row_group_size = 65536
+_lb_pattern = re.compile(r'_l(-?[0-9.]+)_b(-?[0-9.]+)\.(csv|h5|hdf5)$')
+
+def field_name(l, b):
+    """
+    Directory name of the field (l,b) in a store, following the catalog file names.
+    """
+    return f'l{l:.3f}_b{b:.3f}'
+
+def parse_lb(fname):
+    """
+    Return (l, b) from a SynthPop output file name such as Huston2025_l0.250_b-2.150.csv.
+    """
+    match = _lb_pattern.search(os.path.basename(fname))
+    if match is None:
+        raise ValueError(f'Cannot parse l,b from file name: {fname}')
+    return float(match.group(1)), float(match.group(2))
+
+def _read_meta(field_dir):
+    with open(os.path.join(field_dir, 'meta.json')) as f:
+        return json.load(f)
+
+def write_field(df, l, b, store_dir, sort_by=None, columns=None, source=None):
+    """
+    Write one field catalog into the store.
+    inputs:
+        df: DataFrame catalog
+        l, b: field centre (deg)
+        store_dir: store location
+        sort_by: optional column to sort rows by (e.g. the magnitude used for cuts)
+        columns: optional subset of columns to keep
+        source: optional source file, recorded so unchanged files are not reconverted
+    """
+    if columns is not None:
+        df = df[columns]
+    if sort_by is not None:
+        df = df.sort_values(sort_by, kind='stable', na_position='last')
+    field_dir = os.path.join(store_dir, field_name(l, b))
+    os.makedirs(field_dir, exist_ok=True)
+    n = len(df)
+    starts = np.arange(0, n, row_group_size)
+    meta = {'l':l, 'b':b, 'n_rows':n, 'sort_by':sort_by, 'row_group_size':row_group_size,
+            'columns':{}, 'source':None}
+    for i,col in enumerate(df.columns):
+        arr = df[col].to_numpy()
+        if arr.dtype==object:
+            arr = arr.astype(str)
+        # Column names such as Fe/H_initial are not valid file names
+        col_file = f'c{i:03d}.npy'
+        tmp = os.path.join(field_dir, f'.c{i:03d}.{os.getpid()}.tmp.npy')
+        np.save(tmp, arr, allow_pickle=False)
+        os.replace(tmp, os.path.join(field_dir, col_file))
+        entry = {'file':col_file, 'dtype':str(arr.dtype)}
+        if np.issubdtype(arr.dtype, np.number) and n>0:
+            with np.errstate(invalid='ignore'):
+                # NaN-only groups get NaN bounds and are always skipped by range cuts
+                entry['min'] = [float(x) for x in _group_reduce(np.fmin, arr, starts)]
+                entry['max'] = [float(x) for x in _group_reduce(np.fmax, arr, starts)]
+        meta['columns'][col] = entry
+    if source is not None:
+        st = os.stat(source)
+        meta['source'] = {'file':os.path.abspath(source), 'mtime':st.st_mtime, 'size':st.st_size}
+    tmp = os.path.join(field_dir, f'.meta.{os.getpid()}.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp, os.path.join(field_dir, 'meta.json'))
+    return field_dir
+
+def _group_reduce(ufunc, arr, starts):
+    return ufunc.reduceat(arr.astype(float), starts) if len(starts)>0 else np.array([])
+
+def is_current(fname, l, b, store_dir):
+    """
+    True if the store already holds an up-to-date conversion of fname.
+    """
+    try:
+        meta = _read_meta(os.path.join(store_dir, field_name(l, b)))
+    except FileNotFoundError:
+        return False
+    src = meta.get('source')
+    if src is None:
+        return False
+    st = os.stat(fname)
+    return src['file']==os.path.abspath(fname) and src['mtime']==st.st_mtime and src['size']==st.st_size
+
+def read_hdf_columns(fname, columns=None):
+    """
+    Read columns of an h5 model output file. Table-format stores are read
+    column by column; fixed-format stores (the to_hdf default) can only be
+    read whole, so the columns are selected after reading.
+    """
+    if columns is None:
+        return pd.read_hdf(fname)
+    try:
+        return pd.read_hdf(fname, columns=columns)
+    except TypeError:
+        # "cannot pass a column specification when reading a Fixed format store"
+        return pd.read_hdf(fname)[columns]
+
+def convert_file(fname, store_dir, l=None, b=None, sort_by=None, columns=None, force=False):
+    """
+    Convert one csv or h5 model output file into the store (skipped if up to date).
+    l, b default to the values in the file name.
+    """
+    if l is None or b is None:
+        l, b = parse_lb(fname)
+    if not force and is_current(fname, l, b, store_dir):
+        return os.path.join(store_dir, field_name(l, b))
+    if fname.endswith('.csv'):
+        df = pd.read_csv(fname, usecols=columns)
+    else:
+        df = read_hdf_columns(fname, columns)
+    return write_field(df, l, b, store_dir, sort_by=sort_by, columns=columns, source=fname)
+
+def convert_outputs(pattern, store_dir, sort_by=None, columns=None, force=False):
+    """
+    Convert all model output files matching a glob pattern into the store.
+    output:
+        list of field directories written or already current
+    """
+    return [convert_file(fname, store_dir, sort_by=sort_by, columns=columns, force=force)
+            for fname in sorted(glob.glob(pattern))]
+
+def list_fields(store_dir):
+    """
+    DataFrame of the fields (l, b, n_rows, field directory) held in a store.
+    """
+    rows = []
+    for meta_file in sorted(glob.glob(os.path.join(store_dir, '*', 'meta.json'))):
+        meta = _read_meta(os.path.dirname(meta_file))
+        rows.append([meta['l'], meta['b'], meta['n_rows'], os.path.dirname(meta_file)])
+    return pd.DataFrame(rows, columns=['l', 'b', 'n_rows', 'field_dir'])
+
+def _open_column(field_dir, meta, col):
+    return np.load(os.path.join(field_dir, meta['columns'][col]['file']), mmap_mode='r')
+
+def _select_rows(field_dir, meta, where):
+    # Row selection for range cuts {col: (lo, hi)} with lo<x<hi; None means open
+    n = meta['n_rows']
+    size = meta['row_group_size']
+    n_groups = -(-n//size)
+    use_group = np.ones(n_groups, dtype=bool)
+    for col, (lo, hi) in where.items():
+        entry = meta['columns'][col]
+        if 'min' in entry:
+            gmin, gmax = np.array(entry['min']), np.array(entry['max'])
+            with np.errstate(invalid='ignore'):
+                if lo is not None:
+                    use_group &= gmax>lo
+                if hi is not None:
+                    use_group &= gmin<hi
+    groups = np.flatnonzero(use_group)
+    if len(groups)==0:
+        return np.array([], dtype=np.int64)
+    # Contiguous runs of row groups become slices of the memory-mapped columns
+    runs = np.split(groups, np.flatnonzero(np.diff(groups)!=1)+1)
+    idx = []
+    for run in runs:
+        start, stop = run[0]*size, min((run[-1]+1)*size, n)
+        mask = np.ones(stop-start, dtype=bool)
+        for col, (lo, hi) in where.items():
+            vals = _open_column(field_dir, meta, col)[start:stop]
+            if lo is not None:
+                mask &= vals>lo
+            if hi is not None:
+                mask &= vals<hi
+        idx.append(start+np.flatnonzero(mask))
+    return np.concatenate(idx)
+
+def read_field(l, b, store_dir, columns=None, where=None, rename=None):
+    """
+    Read one field from the store.
+    inputs:
+        l, b: field centre (deg)
+        store_dir: store location
+        columns: columns to read (default: all)
+        where: optional magnitude cuts {column: (lo, hi)}, keeping lo<x<hi;
+            use None for an open end, e.g. {'Bessell_I': (None, 18)}
+        rename: optional {column: new name} mapping for the output
+    output:
+        DataFrame with the requested columns and rows
+    """
+    field_dir = os.path.join(store_dir, field_name(l, b))
+    meta = _read_meta(field_dir)
+    if columns is None:
+        columns = list(meta['columns'].keys())
+    idx = None
+    if where:
+        idx = _select_rows(field_dir, meta, where)
+        # A single contiguous block (e.g. a cut on the sort column) is read as a slice
+        if len(idx)>0 and idx[-1]-idx[0]+1==len(idx):
+            idx = slice(idx[0], idx[-1]+1)
+    data = {}
+    for col in columns:
+        arr = _open_column(field_dir, meta, col)
+        data[col] = np.array(arr if idx is None else arr[idx])
+    out = pd.DataFrame(data)
+    if rename is not None:
+        out = out.rename(columns=rename)
+    return out
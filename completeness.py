@@ -0,0 +1,135 @@
+"""
+Completeness corrections for the HST Bulge Treasury catalogs from their
+artificial-star tests.
+
+The correction in each magnitude bin is the ratio of input to recovered
+artificial stars, for a sample of artificial stars drawn to follow the
+observed (recovered) luminosity function: observed counts divided by it
+estimate the true counts, and model counts multiplied by it estimate the
+observed counts. Input and output magnitudes are binned once (a single
+np.digitize over both), the stratified sample is drawn without replacement
+for all bins at once from a seeded generator, and the expected value of the
+resampled estimate can also be computed exactly, without sampling.
+
+Artificial-star tables have {f}IN and {f}OUT columns and catalogs {f}MAG
+columns, for filters C, V, I, J and H.
+
+Current options are:
+    get_completeness(f, cat, sim, mbins)
+    completeness_curves(cats, arts, mbins)
+    star_weights(mags, cplt, mbins)
+"""
+
+import numpy as np
+
+filters = ['C', 'V', 'I', 'J', 'H']
+
+def bin_pairs(mag_in, mag_out, mbins):
+    """
+    Bin indices of input and output magnitudes (np.histogram convention),
+    -1 outside the bins or for NaN.
+    """
+    mags = np.stack([np.asarray(mag_in, dtype=float), np.asarray(mag_out, dtype=float)])
+    nb = len(mbins)-1
+    idx = np.digitize(mags, mbins)-1
+    idx[mags==mbins[-1]] = nb-1
+    idx[(idx<0) | (idx>=nb) | np.isnan(mags)] = -1
+    return idx[0], idx[1]
+
+def scale_factor(cts, scts):
+    """
+    Largest integer sf with cts*sf <= scts in every bin: the number of
+    artificial stars drawn per observed star.
+    """
+    cts, scts = np.asarray(cts), np.asarray(scts)
+    has = cts>0
+    if not np.any(has):
+        return 0
+    return int(np.min(scts[has]//cts[has]))
+
+def _stratified_sample(out_idx, n_draw, rng):
+    # Indices of n_draw[b] stars drawn without replacement from each output bin b
+    ok = np.flatnonzero(out_idx>=0)
+    # Sorting bin + uniform key gives a random order within each bin, bins in order
+    order = ok[np.argsort(out_idx[ok] + rng.random(len(ok)))]
+    bins_sorted = out_idx[order]
+    starts = np.searchsorted(bins_sorted, np.arange(len(n_draw)))
+    rank = np.arange(len(order)) - starts[bins_sorted]
+    return order[rank<n_draw[bins_sorted]]
+
+def _curve(in_idx, out_idx, cts, nb, method, rng):
+    scts = np.bincount(out_idx[out_idx>=0], minlength=nb)
+    sf = scale_factor(cts, scts)
+    n_draw = cts*sf
+    if method=='resample':
+        sel = _stratified_sample(out_idx, n_draw, rng)
+        n_in = np.bincount(in_idx[sel][in_idx[sel]>=0], minlength=nb)
+    elif method=='expected':
+        # Expected input counts of the resample: migration matrix times the drawn output counts
+        ok = (in_idx>=0) & (out_idx>=0)
+        mig = np.bincount(in_idx[ok]*nb+out_idx[ok], minlength=nb*nb).reshape(nb, nb)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            frac = np.where(scts>0, mig/scts, 0.0)
+        n_in = frac @ n_draw
+    else:
+        raise ValueError(f'Unknown method: {method}')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return n_in/n_draw
+
+def get_completeness(f, cat, sim, mbins, seed=0, method='resample'):
+    """
+    Completeness correction curve for one filter of one field.
+    inputs:
+        f: filter (C, V, I, J or H)
+        cat: observed catalog with an {f}MAG column
+        sim: artificial-star table with {f}IN and {f}OUT columns
+        mbins: magnitude bin edges
+        seed: random seed (or np.random.Generator) of the resampling
+        method: 'resample' (stratified draw) or 'expected' (its exact expectation)
+    output:
+        array of input/output ratios per bin (NaN where no stars were drawn);
+        divide observed counts by it to correct them
+    """
+    mbins = np.asarray(mbins, dtype=float)
+    nb = len(mbins)-1
+    cts = np.histogram(cat[f'{f}MAG'], bins=mbins)[0]
+    in_idx, out_idx = bin_pairs(sim[f'{f}IN'], sim[f'{f}OUT'], mbins)
+    rng = np.random.default_rng(seed)
+    return _curve(in_idx, out_idx, cts, nb, method, rng)
+
+def completeness_curves(cats, arts, mbins, use_filters=filters, fields=None, seed=0, method='resample'):
+    """
+    Completeness correction curves for several fields and filters in one call.
+    inputs:
+        cats, arts: lists of observed catalogs and artificial-star tables, one per field
+        mbins: magnitude bin edges
+        use_filters: filters to compute
+        fields: field names (default: 0, 1, ...)
+        seed: random seed; each (field, filter) gets an independent, reproducible stream
+        method: 'resample' or 'expected' (see get_completeness)
+    output:
+        dictionary {field: {filter: curve}}
+    """
+    if fields is None:
+        fields = list(range(len(cats)))
+    mbins = np.asarray(mbins, dtype=float)
+    streams = np.random.SeedSequence(seed).spawn(len(fields)*len(use_filters))
+    curves = {}
+    for i, field in enumerate(fields):
+        curves[field] = {}
+        for j, f in enumerate(use_filters):
+            rng = np.random.default_rng(streams[i*len(use_filters)+j])
+            curves[field][f] = get_completeness(f, cats[i], arts[i], mbins, seed=rng, method=method)
+    return curves
+
+def star_weights(mags, cplt, mbins, fill=np.nan):
+    """
+    Per-star weights applying a completeness curve to a model catalog: each star
+    gets the curve value of its magnitude bin (fill outside the bins), so that
+    weighted model counts can be compared with uncorrected observed counts.
+    """
+    idx = bin_pairs(mags, mags, mbins)[0]
+    w = np.full(len(idx), fill, dtype=float)
+    ok = idx>=0
+    w[ok] = np.asarray(cplt, dtype=float)[idx[ok]]
+    return w
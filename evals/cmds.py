@@ -3,6 +3,7 @@ Module containing methods to test models against
 observed color-magnitude diagrams
 Current options are:
     cmds_ogle_ews(model_data)
+    model_data_from_store(model_stores)
 """
 
 import numpy as np
@@ -15,6 +16,8 @@ import os
 import gzip
 import shutil
 import fetch_data
+import catalog_store
+from evals import histograms
 
 ccyc = ['#377eb8', '#ff7f00', '#4daf4a', '#f781bf', '#a65628', 
         '#984ea3', '#999999', '#e41a1c', '#dede00']
@@ -46,6 +49,33 @@ ogle_ews_cats = fetch_data.ogle_ews_mapdat(ogle_ews_event_list)
 #         data = pd.read_csv(location+event_name+'_map.dat', sep='\s+', usecols=[3,5],header=None, names=['V','I'])
 #     return data
 
+def model_data_from_store(model_stores, columns=['Bessell_V','Bessell_I','pop'],
+                          rename={'Bessell_V':'V','Bessell_I':'I'}, where=None):
+    """
+    Build the model_data input of cmds_ogle_ews from catalog stores (see catalog_store.py),
+    reading only the needed columns (and rows, for magnitude cuts) at each OGLE EWS event.
+    input:
+        model_stores: dictionary with each model name as a key for its store directory
+        columns: catalog columns to read
+        rename: mapping of catalog columns to the V, I names used by cmds_ogle_ews
+        where: optional magnitude cuts, e.g. {'Bessell_I': (None, 18)}
+    output:
+        model_data dictionary for cmds_ogle_ews
+    """
+    model_data = {}
+    for i,ev in enumerate(ogle_ews_event_list):
+        model_data[ev] = {}
+        for model, store_dir in model_stores.items():
+            model_data[ev][model] = catalog_store.read_field(ogle_ews_lb_flt[0][i], ogle_ews_lb_flt[1][i],
+                                        store_dir, columns=columns, where=where, rename=rename)
+    return model_data
+
+def _cmd_window(dat, m_min, m_max, c_min, c_max):
+    # Boolean mask of the stars inside the CMD window, computing the colour only once
+    mag = np.asarray(dat['I'])
+    col = np.asarray(dat['V']) - mag
+    return (mag<m_min) & (mag>m_max) & (col>c_min) & (col<c_max)
+
 def cmds_ogle_ews(model_data, separate_populations=False):
     """
     Module to compare a model catalogs to V,I map data from OGLE EWS.
@@ -79,10 +109,11 @@ def cmds_ogle_ews(model_data, separate_populations=False):
         lstr,bstr = f'{lpnt:3.1f}', f'{lb_flt[1][i]:3.1f}'
         plt.title('OB25'+ev[-4:]+' ('+lstr+','+bstr+')', loc='left')
         dat = ogle_ews_cats[ev]
-        dat = dat[(dat['I']<m_min) & (dat['I']>m_max) & (dat['V']-dat['I']>c_min) & (dat['V']-dat['I']<c_max)]
+        obs_acc = histograms.CMDAccumulator(mbins, cbins, (m_max,m_min), (c_min,c_max)).add(dat['I'], dat['V'])
+        dat = dat[_cmd_window(dat, m_min, m_max, c_min, c_max)]
         plt.plot(dat['V']-dat['I'],dat['I'], 'k.')
         plt.text(c_min+0.1,m_max+0.5,'OGLE EWS')
-        plt.text(c_max-0.1,m_max+0.5,str(len(dat)),c='dimgray',ha='right')
+        plt.text(c_max-0.1,m_max+0.5,str(obs_acc.n_stars),c='dimgray',ha='right')
         plt.xlim(c_min,c_max)
         plt.ylim(m_min,m_max)
         plt.xlabel('V-I')
@@ -92,16 +123,14 @@ def cmds_ogle_ews(model_data, separate_populations=False):
         plt.subplot(len(events),cols,cols-1+i*cols)
         plt.ylabel(r'N$_*$')
         #plt.title('Luminosity Function')
-        hs,_ = np.histogram(dat['I'], bins=mbins)
-        plt.errorbar(mbins[:-1]+np.diff(mbins)/2, hs, yerr=np.sqrt(hs),
+        plt.errorbar(obs_acc.lf.centers, obs_acc.lf.counts, yerr=obs_acc.lf.errors,
                      label='OGLE EWS', color='k', linestyle='none', marker='.')
         plt.xlabel('I')
         ax1=plt.gca()
         
         plt.subplot(len(events),cols,cols+i*cols)
         #plt.title('Color Function')
-        hs,_ = np.histogram(dat['V']-dat['I'], bins=cbins)
-        plt.errorbar(cbins[:-1]+np.diff(cbins)/2, hs, yerr=np.sqrt(hs), 
+        plt.errorbar(obs_acc.cf.centers, obs_acc.cf.counts, yerr=obs_acc.cf.errors, 
                  color='k', linestyle='none', marker='.')
         plt.xlabel('V-I')
         plt.gca().sharey(ax1)
@@ -109,7 +138,8 @@ def cmds_ogle_ews(model_data, separate_populations=False):
     
         for j in range(len(models)):
             all_dat = model_data[ev][models[j]]
-            cdat = all_dat[(all_dat['I']<m_min) & (all_dat['I']>m_max) & (all_dat['V']-all_dat['I']>c_min) & (all_dat['V']-all_dat['I']<c_max)]
+            mod_acc = histograms.CMDAccumulator(mbins, cbins, (m_max,m_min), (c_min,c_max)).add(all_dat['I'], all_dat['V'])
+            cdat = all_dat[_cmd_window(all_dat, m_min, m_max, c_min, c_max)]
             plt.subplot(len(events),cols,2+j+i*cols)
             plt.gca().tick_params(axis='y', labelleft=False)
             #plt.title(models[j])
@@ -123,7 +153,7 @@ def cmds_ogle_ews(model_data, separate_populations=False):
                 pp = cdat['pop']>3.0
                 plt.plot(cdat['V'][pp]-cdat['I'][pp],cdat['I'][pp], marker='.',linestyle='none',c=ccyc[1], label='disk')
                 plt.legend(loc=2)
-            plt.text(c_max-0.1,m_max+0.5,str(len(cdat)),c='dimgray', ha='right')
+            plt.text(c_max-0.1,m_max+0.5,str(mod_acc.n_stars),c='dimgray', ha='right')
             plt.text(c_min+0.1,m_max+0.5,'SP-H25')
             plt.xlim(c_min,c_max)
             plt.ylim(m_min,m_max)
@@ -132,9 +162,9 @@ def cmds_ogle_ews(model_data, separate_populations=False):
             plt.grid(True)
     
             plt.subplot(len(events),cols,cols-1+i*cols)
-            plt.hist(cdat['I'], histtype='step',label=models[j],bins=mbins,linestyle='-')
+            plt.stairs(mod_acc.lf.counts, mbins, label=models[j], linestyle='-')
             plt.subplot(len(events),cols,cols+i*cols)
-            plt.hist(cdat['V']-cdat['I'], histtype='step',bins=cbins,linestyle='-')
+            plt.stairs(mod_acc.cf.counts, cbins, linestyle='-')
 
     
         plt.subplot(len(events),cols,cols-1+i*cols)
@@ -0,0 +1,143 @@
+"""
+Streaming histogram accumulators for luminosity functions, colour
+functions and Hess diagrams.
+
+Accumulators consume catalogs chunk by chunk and keep only the bin counts,
+so memory does not grow with catalog size. Partial results (e.g. from
+several workers, each holding part of a catalog) are combined with merge()
+or +. Binning follows np.histogram: bins are half-open [lo, hi) except the
+last, which includes its upper edge.
+Current options are:
+    Hist1D(edges)
+    Hist2D(xedges, yedges)
+    CMDAccumulator(mbins, cbins, m_lims, c_lims)
+    accumulate(acc, chunks, columns)
+"""
+
+import numpy as np
+
+def bin_index(values, edges):
+    """
+    Bin index of each value for sorted edges (np.histogram convention),
+    or -1 for NaN and out-of-range values.
+    """
+    values = np.asarray(values, dtype=float)
+    nb = len(edges)-1
+    idx = np.searchsorted(edges, values, side='right')-1
+    idx[values==edges[-1]] = nb-1
+    idx[(idx<0) | (idx>=nb) | np.isnan(values)] = -1
+    return idx
+
+class Hist1D:
+    """
+    1-D histogram accumulator (e.g. a luminosity or colour function).
+    """
+    def __init__(self, edges):
+        self.edges = np.asarray(edges, dtype=float)
+        self.counts = np.zeros(len(self.edges)-1)
+        self.n_seen = 0
+
+    def add(self, values, weights=None):
+        idx = bin_index(values, self.edges)
+        ok = idx>=0
+        w = None if weights is None else np.asarray(weights, dtype=float)[ok]
+        self.counts += np.bincount(idx[ok], weights=w, minlength=len(self.counts))
+        self.n_seen += len(idx)
+        return self
+
+    def merge(self, other):
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError('Cannot merge histograms with different bin edges')
+        self.counts += other.counts
+        self.n_seen += other.n_seen
+        return self
+
+    def __add__(self, other):
+        out = Hist1D(self.edges)
+        return out.merge(self).merge(other)
+
+    @property
+    def centers(self):
+        return self.edges[:-1] + np.diff(self.edges)/2
+
+    @property
+    def errors(self):
+        # Poisson errors of unweighted counts
+        return np.sqrt(self.counts)
+
+class Hist2D:
+    """
+    2-D histogram accumulator (e.g. a Hess diagram, with x=colour and y=magnitude).
+    """
+    def __init__(self, xedges, yedges):
+        self.xedges = np.asarray(xedges, dtype=float)
+        self.yedges = np.asarray(yedges, dtype=float)
+        self.counts = np.zeros((len(self.xedges)-1, len(self.yedges)-1))
+        self.n_seen = 0
+
+    def add(self, x, y, weights=None):
+        ix, iy = bin_index(x, self.xedges), bin_index(y, self.yedges)
+        ok = (ix>=0) & (iy>=0)
+        ny = self.counts.shape[1]
+        w = None if weights is None else np.asarray(weights, dtype=float)[ok]
+        flat = np.bincount(ix[ok]*ny+iy[ok], weights=w, minlength=self.counts.size)
+        self.counts += flat.reshape(self.counts.shape)
+        self.n_seen += len(ix)
+        return self
+
+    def merge(self, other):
+        if not (np.array_equal(self.xedges, other.xedges) and np.array_equal(self.yedges, other.yedges)):
+            raise ValueError('Cannot merge histograms with different bin edges')
+        self.counts += other.counts
+        self.n_seen += other.n_seen
+        return self
+
+    def __add__(self, other):
+        out = Hist2D(self.xedges, self.yedges)
+        return out.merge(self).merge(other)
+
+class CMDAccumulator:
+    """
+    Luminosity function, colour function and Hess diagram of the stars in a
+    colour-magnitude window, as used by cmds.cmds_ogle_ews.
+    inputs:
+        mbins, cbins: magnitude and colour bin edges
+        m_lims, c_lims: (lo, hi) window, keeping lo<mag<hi and lo<colour<hi
+    """
+    def __init__(self, mbins, cbins, m_lims, c_lims):
+        self.m_lims, self.c_lims = m_lims, c_lims
+        self.lf = Hist1D(mbins)
+        self.cf = Hist1D(cbins)
+        self.hess = Hist2D(cbins, mbins)
+        self.n_stars = 0
+
+    def add(self, mag, mag_blue):
+        """
+        Add a chunk of stars given magnitudes in the red (e.g. I) and blue (e.g. V) bands.
+        """
+        mag = np.asarray(mag, dtype=float)
+        col = np.asarray(mag_blue, dtype=float) - mag
+        sel = (mag>self.m_lims[0]) & (mag<self.m_lims[1]) & (col>self.c_lims[0]) & (col<self.c_lims[1])
+        mag, col = mag[sel], col[sel]
+        self.lf.add(mag)
+        self.cf.add(col)
+        self.hess.add(col, mag)
+        self.n_stars += len(mag)
+        return self
+
+    def merge(self, other):
+        self.lf.merge(other.lf)
+        self.cf.merge(other.cf)
+        self.hess.merge(other.hess)
+        self.n_stars += other.n_stars
+        return self
+
+def accumulate(acc, chunks, columns):
+    """
+    Feed an accumulator from an iterable of catalog chunks (e.g. DataFrames from
+    pd.read_csv(..., chunksize=...) or catalog_store reads), passing the given
+    columns of each chunk to acc.add.
+    """
+    for chunk in chunks:
+        acc.add(*[chunk[col] for col in columns])
+    return acc
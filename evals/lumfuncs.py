@@ -3,6 +3,8 @@ Module containing methods to test models against
 observed luminosity functions.
 Current options are:
     compare_stanekwindow(model_data, model_area)
+    StanekWindowEval(model_area)
+    fit_stanekwindow_cors(model_data, model_area, offsets)
 """
 
 import numpy as np
@@ -13,7 +15,16 @@ import os
 import gzip
 import shutil
 
+_terry2020_cache = {}
+
 def get_terry2020_lf(location='data/apjab629b/'):
+    """
+    Terry et al. (2020) Stanek Window luminosity functions, downloading the table
+    first if needed. The parsed table is cached, so repeat calls skip the
+    (slow, python-engine) read; a fresh copy is returned each time.
+    """
+    if location in _terry2020_cache:
+        return _terry2020_cache[location].copy()
     data_url = 'https://iopscience.iop.org/0004-637X/889/2/126/suppdata/apjab629bt5_ascii.txt?doi=10.3847/1538-4357/ab629b'
     file_name = 'apjab629bt5_ascii.txt'
     try:
@@ -25,7 +36,165 @@ def get_terry2020_lf(location='data/apjab629b/'):
         urlretrieve(data_url, location+file_name)
         data = pd.read_csv(location+file_name, sep='\s+', skiprows=5, skipfooter=1, header=None, engine='python', 
                           names=['V', 'logN_V', 'I', 'logN_I', 'J', 'logN_J', 'H', 'logN_H'])
-    return data
+    _terry2020_cache[location] = data
+    return data.copy()
+
+def sorted_hist(sorted_vals, edges):
+    """
+    Histogram counts of pre-sorted values (np.histogram convention: bins are
+    [lo, hi) except the last, which includes its upper edge).
+    edges may be 2-D, with one set of bin edges per row.
+    """
+    lo = np.searchsorted(sorted_vals, edges[...,:-1], side='left')
+    hi = np.searchsorted(sorted_vals, edges[...,1:], side='left')
+    hi[...,-1] = np.searchsorted(sorted_vals, edges[...,-1], side='right')
+    return hi - lo
+
+class StanekWindowEval:
+    """
+    Luminosity-function comparison against Terry et al. (2020) in the Stanek Window.
+    The observed table is parsed once and the bin edges of each filter are
+    precomputed (bins of width bin_width centred on the tabulated magnitudes).
+    Model magnitudes are sorted once by prepare(); filter corrections then
+    only shift the bin edges, so the inputs are never copied or modified and
+    a model can be re-scored against many correction vectors cheaply.
+    inputs:
+        model_area: the size of the catalog region in degrees^2
+        use_filters: observed filters to compare, from {'V','I','J','H'}
+        bin_width: width of the Terry et al. (2020) magnitude bins
+    """
+    filt_list = {'V':'WFC3_UVIS_F555W','I':'WFC3_UVIS_F814W','J':'WFC3_IR_F110W','H':'WFC3_IR_F160W'}
+
+    def __init__(self, model_area, use_filters=['V','I','J','H'], bin_width=0.3,
+                 location='data/apjab629b/'):
+        obs_data = get_terry2020_lf(location)
+        self.model_area = model_area
+        self.use_filters = list(use_filters)
+        self.bin_width = bin_width
+        self.obs_mag, self.obs_logn, self.edges = {}, {}, {}
+        for filt in self.use_filters:
+            reals = ~np.isnan(obs_data[filt].to_numpy())
+            self.obs_mag[filt] = obs_data[filt].to_numpy()[reals]
+            self.obs_logn[filt] = obs_data['logN_'+filt].to_numpy()[reals]
+            self.edges[filt] = np.append(self.obs_mag[filt], self.obs_mag[filt][-1]+bin_width) - bin_width/2
+        # Number of model stars per bin corresponding to one star per arcmin^2 per mag
+        self.norm = bin_width * model_area * 60**2
+
+    def prepare(self, model_data):
+        """
+        Sorted, NaN-free model magnitudes for each filter. model_data is a dictionary
+        (or DataFrame) with either the observed filter names or the WFC3 band names.
+        """
+        prepared = {}
+        for filt in self.use_filters:
+            col = filt if filt in model_data else self.filt_list[filt]
+            mags = np.asarray(model_data[col], dtype=float)
+            prepared[filt] = np.sort(mags[~np.isnan(mags)])
+        return prepared
+
+    def model_counts(self, prepared, model_filt_cors=None, obs_filt_cors=None):
+        """
+        Model star counts in each observed bin, for corrections given in the order of use_filters.
+        Subtracting a model correction is equivalent to shifting the bin edges up by it.
+        """
+        counts = {}
+        for i,filt in enumerate(self.use_filters):
+            shift = 0.0
+            if model_filt_cors is not None:
+                shift += model_filt_cors[i]
+            if obs_filt_cors is not None:
+                shift += obs_filt_cors[i]
+            counts[filt] = sorted_hist(prepared[filt], self.edges[filt]+shift)
+        return counts
+
+    def model_density(self, prepared, model_filt_cors=None, obs_filt_cors=None):
+        """
+        Model luminosity functions in stars per arcmin^2 per mag.
+        """
+        counts = self.model_counts(prepared, model_filt_cors, obs_filt_cors)
+        return {filt: counts[filt]/self.norm for filt in counts}
+
+    def expected_counts(self, filt):
+        """
+        Star counts per bin implied by the observed luminosity function for the model area.
+        """
+        return 10**self.obs_logn[filt] * self.norm
+
+    def score(self, prepared, model_filt_cors=None, obs_filt_cors=None):
+        """
+        Poisson deviance of the model counts about the counts implied by the
+        observed luminosity functions, summed over filters (lower is better).
+        """
+        counts = self.model_counts(prepared, model_filt_cors, obs_filt_cors)
+        return sum(poisson_deviance(counts[filt], self.expected_counts(filt)) for filt in counts)
+
+    def sweep(self, prepared, offsets, obs_filt_cors=None, full_surface=False):
+        """
+        Evaluate the fit over a grid of model filter corrections in one pass per filter.
+        Each filter's counts only depend on its own correction, so the deviance is
+        computed for all grid values of a filter at once (counts at the shifted
+        edges of every grid value from a single searchsorted) and the surface is
+        the outer sum of the per-filter curves.
+        inputs:
+            prepared: output of prepare(model_data)
+            offsets: list of 1-D grids of model corrections, one per filter in use_filters
+            obs_filt_cors: optional fixed corrections to the observations
+            full_surface: if True, also return the joint surface over all filters
+                (its size is the product of the grid lengths)
+        output:
+            dictionary with
+                'best': best model correction for each filter
+                'deviance': list of per-filter deviance curves over the grids
+                'loglike_1d': list of per-filter log-likelihood curves (-deviance/2)
+                'loglike': log-likelihood surface (-deviance/2, up to a constant),
+                    of shape (len(offsets[0]), len(offsets[1]), ...), if full_surface
+        """
+        if len(offsets)!=len(self.use_filters):
+            raise ValueError('Need one grid of offsets per filter in use_filters')
+        best, curves = [], []
+        for i,filt in enumerate(self.use_filters):
+            grid = np.atleast_1d(np.asarray(offsets[i], dtype=float))
+            shift = grid + (obs_filt_cors[i] if obs_filt_cors is not None else 0.0)
+            counts = sorted_hist(prepared[filt], self.edges[filt][None,:]+shift[:,None])
+            dev = poisson_deviance(counts, self.expected_counts(filt)[None,:])
+            curves.append(dev)
+            best.append(grid[np.argmin(dev)])
+        out = {'best':np.array(best), 'deviance':curves, 'loglike_1d':[-dev/2 for dev in curves]}
+        if full_surface:
+            surface = np.zeros([len(c) for c in curves])
+            for i,dev in enumerate(curves):
+                shape = [1]*len(curves)
+                shape[i] = len(dev)
+                surface = surface + dev.reshape(shape)
+            out['loglike'] = -surface/2
+        return out
+
+def fit_stanekwindow_cors(model_data, model_area, offsets, obs_filt_cors=None,
+                          use_filters=['V','I','J','H'], full_surface=False):
+    """
+    Find the model filter corrections (model_filt_cors for compare_stanekwindow)
+    that best match the Terry et al. 2020 luminosity functions over a grid.
+    inputs:
+        model_data: dictionary of model magnitudes (see compare_stanekwindow)
+        model_area: the size of the catalog region in degrees^2
+        offsets: list of 1-D grids of corrections, one per filter in use_filters,
+            e.g. [np.arange(-1,1,0.01)+c for c in first_guess]
+        obs_filt_cors: optional fixed corrections to the observations
+    output:
+        dictionary from StanekWindowEval.sweep ('best', 'deviance', 'loglike_1d' and,
+        if full_surface, 'loglike')
+    """
+    ev = StanekWindowEval(model_area, use_filters)
+    return ev.sweep(ev.prepare(model_data), offsets, obs_filt_cors, full_surface)
+
+def poisson_deviance(n, mu, axis=-1):
+    """
+    Poisson deviance 2*sum(mu - n + n*ln(n/mu)) of counts n about expectations mu.
+    """
+    n = np.asarray(n, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        term = np.where(n>0, n*np.log(n/mu), 0.0)
+    return 2*np.sum(mu - n + term, axis=axis)
     
 def compare_stanekwindow(model_data, model_area, model_filt_cors=None, obs_filt_cors=None,
                             use_filters=['V','I','J','H']):
@@ -34,27 +203,23 @@ def compare_stanekwindow(model_data, model_area, model_filt_cors=None, obs_filt_
     (l,b = 0.25,-2.15) from Terry et al. 2020.
     inputs:
         model_data: dictionary containing the following data arrays for the model catalog:
-            {'V', 'I', 'J', 'H'} (apparent magnitudes)
+            {'V', 'I', 'J', 'H'} (apparent magnitudes), or the corresponding WFC3 bands
         model_area: the size of the catalog region in degrees^2
+        model_filt_cors, obs_filt_cors: optional magnitude corrections for each filter,
+            subtracted from the model and added to the observations; inputs are not modified
     output:
         a plot of the luminosity function histograms for each band
     """
-    obs_data = get_terry2020_lf()
-    filt_list = {'V':'WFC3_UVIS_F555W','I':'WFC3_UVIS_F814W','J':'WFC3_IR_F110W','H':'WFC3_IR_F160W'}
+    ev = StanekWindowEval(model_area, use_filters)
+    density = ev.model_density(ev.prepare(model_data), model_filt_cors, obs_filt_cors)
     fig, axs = plt.subplots(1,len(use_filters),figsize=(3.5*len(use_filters),3.5))
     for i,filt in enumerate(use_filters):
-        if obs_filt_cors is not None:
-            obs_data[filt] = obs_data[filt] + obs_filt_cors[i]
-        axs[i].step(obs_data[filt], 10**obs_data['logN_'+filt], where='mid', label='Terry+20')
+        obs_cor = obs_filt_cors[i] if obs_filt_cors is not None else 0.0
+        axs[i].step(ev.obs_mag[filt]+obs_cor, 10**ev.obs_logn[filt], where='mid', label='Terry+20')
         axs[i].set_xlabel(filt,fontsize=14)
 
-        bin_width=0.3
-        mod_bins = np.array(obs_data[filt][~np.isnan(obs_data[filt])])
-        mod_filt = filt_list[filt]
-        if model_filt_cors is not None:
-            model_data[mod_filt] = model_data[mod_filt]-model_filt_cors[i]
-        mod_hist = np.log10(np.histogram(model_data[mod_filt], bins=mod_bins)[0]/ bin_width / model_area / 60**2)
-        axs[i].stairs(10**mod_hist, mod_bins, label='SP-H25')
+        mod_bins = ev.edges[filt]+obs_cor
+        axs[i].stairs(density[filt], mod_bins, label='SP-H25')
         axs[i].set_xlim(mod_bins[0], mod_bins[-1])
         axs[i].set_ylim(10**1,10**4.4)
         axs[i].set_yscale('log')
@@ -63,4 +228,4 @@ def compare_stanekwindow(model_data, model_area, model_filt_cors=None, obs_filt_
 
     #plt.suptitle("Luminosity functions toward the Stanek Window\n(l,b) = (0.25,-2.15), data from Terry et al. (2020)")
     fig.tight_layout()
-    return fig
\ No newline at end of file
+    return fig
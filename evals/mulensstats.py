@@ -1,6 +1,190 @@
 """
-Module containing methods to test models against 
+Module containing methods to test models against
 observed microlensing event rates and timescales
 Current options are:
-    [none]
+    aggregate(chips, group)
+    chips_to_fields(chips, chip_names)
+    chips_to_bins(chips, l_bins, b_bins)
+    nearest_grid(l, b, grid)
+
+Per-chip results of batch_rates (one row per chip with eventrate_area,
+eventrate_source, avg_tau, avg_t, avg_logt, n_source and sa_source) are
+combined into OGLE fields or (l,b) bins with one factorized group-by: every
+statistic is a ratio of per-group sums, accumulated with np.bincount. The
+same sums give bootstrap errors for all groups and statistics at once, by
+resampling the chips within each group for every bootstrap draw in a single
+array operation. Grids of other quantities (e.g. blend ratios) are matched
+to chips with a KD-tree nearest-neighbour query.
 """
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+from evals import histograms
+
+rate_props = ['eventrate_area', 'eventrate_source', 'avg_tau', 'avg_t', 'avg_logt']
+
+def _terms(chips, props, weighting, ratio):
+    # Numerator and denominator of each statistic per chip: stat = sum(num)/sum(den)
+    n = len(chips)
+    if weighting=='mean':
+        w_src, w_evt, cor = np.ones(n), np.ones(n), np.ones(n)
+    elif weighting=='sources':
+        # Per-source quantities are weighted by source density, timescales by event rate per area
+        w_src = chips['n_source'].to_numpy(dtype=float)/chips['sa_source'].to_numpy(dtype=float)
+        w_evt = chips['eventrate_area'].to_numpy(dtype=float)
+        cor = np.ones(n) if ratio is None else np.asarray(ratio, dtype=float)
+    else:
+        raise ValueError(f'Unknown weighting: {weighting}')
+    num, den = np.empty((len(props), n)), np.empty((len(props), n))
+    for i, prop in enumerate(props):
+        val = chips[prop].to_numpy(dtype=float)
+        if prop in ('eventrate_source', 'avg_tau'):
+            # Blend ratio (detected/true sources) corrects the per-source normalization
+            num[i], den[i] = val*w_src, w_src*cor
+        elif prop in ('avg_t', 'avg_logt'):
+            num[i], den[i] = val*w_evt, w_evt
+        else:
+            num[i], den[i] = val, np.ones(n)
+    return num, den
+
+def _group_sums(num, den, group, n_groups, skipna):
+    # Per-group sums of (n_props, n_chips) terms; NaN chips are left out if skipna
+    if skipna:
+        bad = np.isnan(num) | np.isnan(den)
+        num, den = np.where(bad, 0, num), np.where(bad, 0, den)
+    keys = (np.arange(num.shape[0])[:,None]*n_groups + group[None,:]).ravel()
+    size = num.shape[0]*n_groups
+    s_num = np.bincount(keys, weights=num.ravel(), minlength=size).reshape(-1, n_groups)
+    s_den = np.bincount(keys, weights=den.ravel(), minlength=size).reshape(-1, n_groups)
+    return s_num, s_den
+
+def _bootstrap(num, den, group, n_groups, n_boot, seed, skipna):
+    # Standard deviation over n_boot resamplings of the chips within each group
+    order = np.argsort(group, kind='stable')
+    sizes = np.bincount(group, minlength=n_groups)
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    g_sorted = group[order]
+    rng = np.random.default_rng(seed)
+    draw = order[starts[g_sorted] + (rng.random((n_boot, len(order)))*sizes[g_sorted]).astype(np.int64)]
+    # Each bootstrap draw is its own set of groups: key = draw*n_groups + group
+    boot_group = (np.arange(n_boot)[:,None]*n_groups + g_sorted[None,:]).ravel()
+    s_num, s_den = _group_sums(num[:, draw.ravel()], den[:, draw.ravel()], boot_group,
+                               n_boot*n_groups, skipna)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        stats = (s_num/s_den).reshape(num.shape[0], n_boot, n_groups)
+    return np.nanstd(stats, axis=1, ddof=1) if n_boot>1 else np.full((num.shape[0], n_groups), np.nan)
+
+def aggregate(chips, group, props=rate_props, weighting='mean', ratio=None, n_boot=0, seed=0, skipna=True):
+    """
+    Combine per-chip microlensing statistics into groups of chips.
+    inputs:
+        chips: DataFrame of per-chip results (batch_rates output)
+        group: group label of each chip (e.g. field name), NaN/None to leave a chip out
+        props: statistics to combine
+        weighting: 'mean' (plain average over chips) or 'sources' (eventrate_source
+            and avg_tau weighted by source density n_source/sa_source, avg_t and
+            avg_logt by eventrate_area, eventrate_area averaged)
+        ratio: optional blend ratio of each chip (detected/true sources) dividing
+            the source-density weights of eventrate_source and avg_tau ('sources' only)
+        n_boot: number of bootstrap resamplings of the chips in each group (0 for none)
+        seed: random seed of the bootstrap
+        skipna: if True, chips with NaN in a statistic are left out of it;
+            otherwise NaN propagates to the group
+    output:
+        DataFrame indexed by group label with n_chips, each statistic and, if
+        n_boot>0, its bootstrap error e_{prop}
+    """
+    codes, labels = pd.factorize(pd.Series(np.asarray(group, dtype=object)), sort=True)
+    use = codes>=0
+    chips = chips[use]
+    ratio = None if ratio is None else np.asarray(ratio, dtype=float)[use]
+    group = codes[use]
+    n_groups = len(labels)
+    num, den = _terms(chips, props, weighting, ratio)
+    s_num, s_den = _group_sums(num, den, group, n_groups, skipna)
+    out = pd.DataFrame({'n_chips':np.bincount(group, minlength=n_groups)}, index=labels)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for i, prop in enumerate(props):
+            out[prop] = s_num[i]/s_den[i]
+    if n_boot>0:
+        err = _bootstrap(num, den, group, n_groups, n_boot, seed, skipna)
+        for i, prop in enumerate(props):
+            out['e_'+prop] = err[i]
+    return out
+
+def field_of(chip_names):
+    """
+    OGLE field name of each subfield (chip) name, e.g. 'BLG501' for 'BLG501.01'.
+    """
+    return np.char.partition(np.asarray(chip_names).astype(str), '.')[:,0]
+
+def chips_to_fields(chips, chip_names, min_chips=17, **kwargs):
+    """
+    Combine per-chip statistics into OGLE-IV fields.
+    inputs:
+        chips: DataFrame of per-chip results, in the order of chip_names
+        chip_names: subfield name of each chip (e.g. subfs_inmap.index)
+        min_chips: fields with fewer chips are set to NaN (mostly outside the map)
+        kwargs: passed to aggregate (props, weighting, n_boot, ...)
+    output:
+        DataFrame indexed by field name (see aggregate)
+    """
+    out = aggregate(chips, field_of(chip_names), **kwargs)
+    out.index.name = 'field'
+    few = out['n_chips']<min_chips
+    out.loc[few, out.columns!='n_chips'] = np.nan
+    return out
+
+def chips_to_bins(chips, l_bins, b_bins, l_col='l', b_col='b', **kwargs):
+    """
+    Combine per-chip statistics into (l,b) bins (np.histogram convention).
+    inputs:
+        chips: DataFrame of per-chip results with l_col and b_col columns
+        l_bins, b_bins: bin edges (deg)
+        kwargs: passed to aggregate (props, weighting, ratio, n_boot, ...)
+    output:
+        DataFrame with one row per bin, l bin by l bin and b bin by b bin within
+        each (row l_bin*(len(b_bins)-1)+b_bin): l_bin, b_bin (bin indices),
+        l_mid, b_mid (bin centres) and the columns of aggregate; empty bins
+        have n_chips 0 and NaN statistics
+    """
+    l_bins, b_bins = np.asarray(l_bins, dtype=float), np.asarray(b_bins, dtype=float)
+    il = histograms.bin_index(chips[l_col].to_numpy(), l_bins)
+    ib = histograms.bin_index(chips[b_col].to_numpy(), b_bins)
+    nl, nb = len(l_bins)-1, len(b_bins)-1
+    code = np.where((il>=0) & (ib>=0), il*nb+ib, -1)
+    out = aggregate(chips, np.where(code>=0, code, np.nan), **kwargs)
+    out.index = out.index.to_numpy().astype(np.int64)
+    out = out.reindex(np.arange(nl*nb))
+    out['n_chips'] = out['n_chips'].fillna(0).astype(np.int64)
+    code = out.index.to_numpy()
+    out.insert(0, 'l_bin', code//nb)
+    out.insert(1, 'b_bin', code%nb)
+    out.insert(2, 'l_mid', 0.5*(l_bins[code//nb]+l_bins[code//nb+1]))
+    out.insert(3, 'b_mid', 0.5*(b_bins[code%nb]+b_bins[code%nb+1]))
+    return out.reset_index(drop=True)
+
+def nearest_grid(l, b, grid, columns=None, l_col='l', b_col='b', max_dist=np.inf):
+    """
+    Values of the nearest grid point to each position (e.g. blend ratios for chips).
+    inputs:
+        l, b: positions (deg)
+        grid: DataFrame of grid points with l_col and b_col columns
+        columns: grid columns to return (default: all)
+        max_dist: positions farther than this (deg) from every grid point get NaN
+    output:
+        DataFrame aligned with l, b, with the grid columns and the distance 'dist'
+        to the matched grid point
+    """
+    tree = cKDTree(np.column_stack([grid[l_col].to_numpy(dtype=float), grid[b_col].to_numpy(dtype=float)]))
+    dist, idx = tree.query(np.column_stack([np.asarray(l, dtype=float), np.asarray(b, dtype=float)]),
+                           distance_upper_bound=max_dist)
+    found = idx<len(grid)
+    if columns is None:
+        columns = list(grid.columns)
+    out = grid[columns].iloc[np.where(found, idx, 0)].reset_index(drop=True)
+    out = out.astype({col: float for col in columns if pd.api.types.is_integer_dtype(out[col].dtype)})
+    out.loc[~found] = np.nan
+    out['dist'] = dist
+    return out
@@ -1,6 +1,269 @@
 """
-Module containing methods to test models against 
+Module containing methods to test models against
 observed proper motions
 Current options are:
-    [none]
+    compare_pms(model_pms, obs_pms, edges)
+    pack(arrays)
+    binned_counts(packed, edges)
+    moments(packed)
+    ks_distance(packed_a, packed_b)
+    ad_distance(packed_a, packed_b)
+    fit_gaussian_mixtures(packed, n_comp)
+
+Many fields are handled at once as "packed" samples: the values of all
+fields concatenated (NaNs dropped), sorted by field and then value, with
+the start offset of each field. Histograms, moments, two-sample distances
+and Gaussian mixture fits are then computed for every field in a few
+batched NumPy operations instead of one field (and one curve_fit) at a time.
 """
+
+import numpy as np
+import pandas as pd
+from evals import histograms
+
+def pack(arrays):
+    """
+    Pack a list of 1-D samples (e.g. mul for each field) for batched evaluation.
+    output:
+        dictionary with 'values' (sorted within each field), 'group' (field index
+        of each value), 'starts' (offset of each field), 'n' (size of each field)
+    """
+    arrays = [np.asarray(a, dtype=float).ravel() for a in arrays]
+    arrays = [np.sort(a[~np.isnan(a)]) for a in arrays]
+    n = np.array([len(a) for a in arrays], dtype=np.int64)
+    starts = np.concatenate([[0], np.cumsum(n)[:-1]]).astype(np.int64)
+    values = np.concatenate(arrays) if len(arrays)>0 else np.array([])
+    group = np.repeat(np.arange(len(arrays)), n)
+    return {'values':values, 'group':group, 'starts':starts, 'n':n}
+
+def _group_sum(packed, x):
+    return np.bincount(packed['group'], weights=x, minlength=len(packed['n']))
+
+def binned_counts(packed, edges, density=False):
+    """
+    Histograms of every field, shape (n_fields, n_bins); with density=True,
+    normalized like np.histogram(..., density=True).
+    """
+    edges = np.asarray(edges, dtype=float)
+    nb = len(edges)-1
+    idx = histograms.bin_index(packed['values'], edges)
+    ok = idx>=0
+    counts = np.bincount(packed['group'][ok]*nb+idx[ok],
+                         minlength=len(packed['n'])*nb).reshape(-1, nb).astype(float)
+    if density:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            counts = counts/counts.sum(axis=1, keepdims=True)/np.diff(edges)
+    return counts
+
+def moments(packed):
+    """
+    Per-field sample statistics: n, mean, std, skewness, excess kurtosis,
+    median and interquartile range.
+    output:
+        DataFrame with one row per field
+    """
+    n = packed['n'].astype(float)
+    x = packed['values']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = _group_sum(packed, x)/n
+        d = x - mean[packed['group']]
+        var = _group_sum(packed, d**2)/n
+        std = np.sqrt(var*n/(n-1))
+        skew = _group_sum(packed, d**3)/n/var**1.5
+        kurt = _group_sum(packed, d**4)/n/var**2 - 3
+    return pd.DataFrame({'n':packed['n'], 'mean':mean, 'std':std, 'skew':skew, 'kurtosis':kurt,
+                         'median':quantiles(packed, 0.5),
+                         'iqr':quantiles(packed, 0.75)-quantiles(packed, 0.25)})
+
+def quantiles(packed, q):
+    """
+    Per-field quantile q (linear interpolation, as np.quantile); NaN for empty fields.
+    """
+    n, starts = packed['n'], packed['starts']
+    pos = q*(n-1)
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.minimum(lo+1, n-1)
+    frac = pos-lo
+    out = np.full(len(n), np.nan)
+    has = n>0
+    v = packed['values']
+    out[has] = v[starts[has]+lo[has]]*(1-frac[has]) + v[starts[has]+hi[has]]*frac[has]
+    return out
+
+def _pooled(packed_a, packed_b):
+    # Pool two packed samples field by field: sorted values, field index and sample-a flags
+    if len(packed_a['n'])!=len(packed_b['n']):
+        raise ValueError('Both samples need the same number of fields')
+    vals = np.concatenate([packed_a['values'], packed_b['values']])
+    group = np.concatenate([packed_a['group'], packed_b['group']])
+    is_a = np.concatenate([np.ones(len(packed_a['values'])), np.zeros(len(packed_b['values']))])
+    order = np.lexsort((vals, group))
+    vals, group, is_a = vals[order], group[order], is_a[order]
+    n_tot = packed_a['n']+packed_b['n']
+    starts = np.concatenate([[0], np.cumsum(n_tot)[:-1]]).astype(np.int64)
+    # Rank within the field (1..N) and running count of sample-a values
+    rank = np.arange(len(vals)) - starts[group] + 1
+    cum_a = np.cumsum(is_a)
+    cum_a = cum_a - np.concatenate([[0], cum_a])[starts][group]
+    # Last element of each run of tied values within a field
+    last = np.ones(len(vals), dtype=bool)
+    last[:-1] = (vals[1:]!=vals[:-1]) | (group[1:]!=group[:-1])
+    return vals, group, rank, cum_a, last, n_tot
+
+def ks_distance(packed_a, packed_b):
+    """
+    Two-sample Kolmogorov-Smirnov distance (max |F_a - F_b|) for every field.
+    NaN for fields where either sample is empty.
+    """
+    na, nb = packed_a['n'].astype(float), packed_b['n'].astype(float)
+    _, group, rank, cum_a, last, _ = _pooled(packed_a, packed_b)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        diff = np.abs(cum_a/na[group] - (rank-cum_a)/nb[group])
+    diff = np.where(last, diff, 0.0)
+    ks = np.zeros(len(na))
+    np.maximum.at(ks, group, np.nan_to_num(diff))
+    ks[(na==0) | (nb==0)] = np.nan
+    return ks
+
+def ad_distance(packed_a, packed_b):
+    """
+    Two-sample Anderson-Darling statistic for every field, in the midrank
+    form that allows for ties (A2akN of Scholz & Stephens 1987, eq. 7, the
+    unnormalized statistic of scipy.stats.anderson_ksamp):
+    (N-1)/N^2 sum_j l_j sum_{s=a,b} (N M_sj - n_s B_j)^2 / n_s / (B_j (N-B_j) - N l_j/4),
+    over the distinct pooled values z_j, with l_j the number of values tied at
+    z_j, B_j the number below z_j plus l_j/2 and M_sj the same count for sample s.
+    NaN for fields where either sample is empty.
+    """
+    m, n = packed_a['n'].astype(float), packed_b['n'].astype(float)
+    _, group, rank, cum_a, last, n_tot = _pooled(packed_a, packed_b)
+    # Counts up to each distinct value, and within its run of ties
+    idx = np.flatnonzero(last)
+    g, r, ca = group[idx], rank[idx].astype(float), cum_a[idx]
+    same = np.concatenate([[False], g[1:]==g[:-1]])
+    l = r - np.where(same, np.concatenate([[0], r[:-1]]), 0)
+    fa = ca - np.where(same, np.concatenate([[0], ca[:-1]]), 0)
+    N, mg, ng = n_tot[g].astype(float), m[g], n[g]
+    B = r - l/2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        term = l*((N*(ca-fa/2) - mg*B)**2/mg + (N*((r-ca)-(l-fa)/2) - ng*B)**2/ng) \
+            / (B*(N-B) - N*l/4)
+        N_f = n_tot.astype(float)
+        ad = np.bincount(g, weights=term, minlength=len(m))*(N_f-1)/N_f**2
+    ad[(m==0) | (n==0)] = np.nan
+    return ad
+
+def _binned_points(packed, bin_width):
+    # Occupied fine bins of every field, as weighted points (bin centre, count)
+    x, g = packed['values'], packed['group']
+    if bin_width is None or len(x)==0:
+        return x, g, np.ones(len(x))
+    key = np.floor((x-x.min())/bin_width).astype(np.int64)
+    n_keys = key.max()+1
+    uniq, counts = np.unique(g*n_keys+key, return_counts=True)
+    return x.min()+(uniq%n_keys+0.5)*bin_width, uniq//n_keys, counts.astype(float)
+
+def fit_gaussian_mixtures(packed, n_comp=2, n_iter=500, tol=1e-6, min_sigma=1e-3, bin_width=0.1):
+    """
+    Fit a 1-D Gaussian mixture to every field at once by expectation-maximization.
+    Initial guesses are set for all fields together: component means at evenly
+    spaced quantiles of each field, the field's standard deviation as widths
+    and equal weights. The fit runs on the occupied bins of a fine grid
+    (bin_width, in the units of the data) weighted by their counts, so its cost
+    is set by the number of occupied bins rather than of stars; the bin
+    variance (bin_width^2/12) is removed from the widths.
+    inputs:
+        packed: packed samples
+        n_comp: number of Gaussian components
+        n_iter: maximum number of EM iterations
+        tol: a field stops iterating once its mean log-likelihood changes by less than tol
+        min_sigma: floor on the component widths
+        bin_width: width of the fine grid; None to fit every value
+    output:
+        dictionary of arrays: 'weight', 'mean', 'sigma' (n_fields, n_comp), ordered
+        by mean, 'loglike' (n_fields), 'converged' (n_fields) and 'n_iter'
+    """
+    n_fields = len(packed['n'])
+    n = packed['n'].astype(float)
+    x, g, w = _binned_points(packed, bin_width)
+    qs = (np.arange(n_comp)+0.5)/n_comp
+    mean = np.stack([quantiles(packed, q) for q in qs], axis=1)
+    sigma = np.repeat(np.sqrt(np.fmax(moments(packed)['std'].to_numpy()**2, min_sigma**2))[:,None], n_comp, axis=1)
+    weight = np.full((n_fields, n_comp), 1.0/n_comp)
+    # Empty fields get finite placeholders and NaN results
+    empty = n==0
+    mean[empty], sigma[empty] = 0.0, 1.0
+    loglike = np.full(n_fields, np.nan)
+    # Fields drop out of the iteration once converged
+    active = ~empty
+    pts = np.ones(len(x), dtype=bool)
+    for it in range(n_iter):
+        xa, ga, wa = x[pts], g[pts], w[pts]
+        # E-step: responsibilities of every point, using its own field's parameters
+        sg = sigma[ga]
+        logp = np.log(weight[ga]/sg) - 0.5*np.log(2*np.pi) - 0.5*((xa[:,None]-mean[ga])/sg)**2
+        top = logp.max(axis=1, keepdims=True)
+        lse = top[:,0] + np.log(np.exp(logp-top).sum(axis=1))
+        resp = np.exp(logp-lse[:,None])*wa[:,None]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            new_ll = np.bincount(ga, weights=lse*wa, minlength=n_fields)/n
+        # M-step: per-field, per-component sums
+        nk = np.stack([np.bincount(ga, weights=resp[:,k], minlength=n_fields) for k in range(n_comp)], axis=1)
+        sx = np.stack([np.bincount(ga, weights=resp[:,k]*xa, minlength=n_fields) for k in range(n_comp)], axis=1)
+        sxx = np.stack([np.bincount(ga, weights=resp[:,k]*xa**2, minlength=n_fields) for k in range(n_comp)], axis=1)
+        upd = active[:,None] & (nk>0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            new_mean = sx/nk
+            new_var = sxx/nk - new_mean**2
+        mean = np.where(upd, new_mean, mean)
+        sigma = np.where(upd, np.sqrt(np.fmax(new_var, min_sigma**2)), sigma)
+        weight = np.where(active[:,None], np.maximum(nk, 1e-12)/np.maximum(n[:,None], 1), weight)
+        converged = active & (np.abs(new_ll-loglike)<tol)
+        loglike = np.where(active, new_ll, loglike)
+        active &= ~converged
+        if not np.any(active):
+            break
+        pts = active[g]
+    if bin_width is not None:
+        sigma = np.sqrt(np.fmax(sigma**2 - bin_width**2/12, min_sigma**2))
+    order = np.argsort(mean, axis=1)
+    res = {'weight':np.take_along_axis(weight, order, 1), 'mean':np.take_along_axis(mean, order, 1),
+           'sigma':np.take_along_axis(sigma, order, 1), 'loglike':loglike, 'converged':~active,
+           'n_iter':it+1}
+    for key in ('weight', 'mean', 'sigma'):
+        res[key][empty] = np.nan
+    res['loglike'][empty] = np.nan
+    return res
+
+def compare_pms(model_pms, obs_pms, edges=np.arange(-15, 15.01, 0.5), components=('mul', 'mub')):
+    """
+    Compare model and observed proper-motion distributions for many fields at once.
+    inputs:
+        model_pms, obs_pms: lists (one entry per field) of DataFrames or dictionaries
+            with the proper-motion components (mas/yr)
+        edges: histogram bin edges (mas/yr)
+        components: proper-motion columns to compare
+    output:
+        DataFrame with one row per field and, for each component, model and
+        observed means, dispersions and medians, the KS and AD distances and
+        the chi^2 between the normalized histograms
+    """
+    out = {}
+    for comp in components:
+        pm_mod = pack([d[comp] for d in model_pms])
+        pm_obs = pack([d[comp] for d in obs_pms])
+        mom_mod, mom_obs = moments(pm_mod), moments(pm_obs)
+        for stat in ('n', 'mean', 'std', 'median'):
+            out[f'{comp}_{stat}_model'] = mom_mod[stat].to_numpy()
+            out[f'{comp}_{stat}_obs'] = mom_obs[stat].to_numpy()
+        out[f'{comp}_ks'] = ks_distance(pm_mod, pm_obs)
+        out[f'{comp}_ad'] = ad_distance(pm_mod, pm_obs)
+        # Chi^2 of the model histogram scaled to the observed number of stars
+        h_mod, h_obs = binned_counts(pm_mod, edges), binned_counts(pm_obs, edges)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scale = h_obs.sum(axis=1, keepdims=True)/h_mod.sum(axis=1, keepdims=True)
+            exp = h_mod*scale
+            var = h_obs + exp*scale
+            chi2 = np.where(var>0, (h_obs-exp)**2/var, 0.0).sum(axis=1)
+        out[f'{comp}_chi2'] = chi2
+    return pd.DataFrame(out)
@@ -1,6 +1,185 @@
 """
-Module containing methods to test models against 
+Module containing methods to test models against
 observed star counts
 Current options are:
-    [none]
+    compare_ogle_starcounts(model_counts, ogle_surfdens)
+    join_counts(model_counts, ogle_surfdens)
+    count_stats(joined)
+    map_data(table, column)
+
+Model counts per OGLE-IV subfield (as written by catalog_gen.ogle_starcounts,
+with field, l, b, n{lim} and sigma{lim} columns) are joined to the Mroz et al.
+2019 surface densities (sigma{lim}) with one merge on the subfield name.
+Ratio, log-ratio, fractional and Poisson residual columns are then computed
+for all subfields at once, and the subfield outlines for maps are taken from
+the cached ogle_geometry index, so re-scoring a new model run takes a few
+vectorized operations rather than a lookup per subfield.
 """
+
+import numpy as np
+import pandas as pd
+import ogle_geometry
+
+_index_cache = {}
+
+def _geometry_index(cache_file):
+    # The geometry index is loaded once per process and cache file
+    if cache_file not in _index_cache:
+        _index_cache[cache_file] = ogle_geometry.load_index(cache_file)
+    return _index_cache[cache_file]
+
+def read_model_counts(model_counts):
+    """
+    Model star counts indexed by subfield name, from a DataFrame or a csv
+    file (e.g. 'outputfiles/ogle_sim_surfdens.csv').
+    """
+    if isinstance(model_counts, str):
+        model_counts = pd.read_csv(model_counts)
+    if 'field' in model_counts.columns:
+        model_counts = model_counts.set_index('field')
+    return model_counts
+
+def count_limits(model_counts, ogle_surfdens):
+    """
+    Magnitude limits (as column suffixes, e.g. '21') with sigma{lim} columns
+    in both tables.
+    """
+    obs_cols = set(ogle_surfdens.columns)
+    return [col[5:] for col in model_counts.columns
+            if col.startswith('sigma') and col in obs_cols]
+
+def join_counts(model_counts, ogle_surfdens=None, maglims=None):
+    """
+    Join model and observed star counts on subfield name, with comparison columns.
+    inputs:
+        model_counts: DataFrame or csv file of model counts (see read_model_counts)
+        ogle_surfdens: observed surface densities indexed by subfield
+            (default: fetch_data.ogle_mroz2019()[0])
+        maglims: magnitude limits to compare, as column suffixes (default: all in both tables)
+    output:
+        DataFrame indexed by subfield, for the subfields in both tables, with
+        l, b and for each limit:
+            sigma{lim}_model, sigma{lim}_obs: surface densities (stars/arcmin^2)
+            ratio{lim}: model/observed
+            logratio{lim}: log10 of the ratio
+            frac{lim}: (model-observed)/observed
+            z{lim}: Poisson residual (n_model-n_expected)/sqrt(n_expected), where
+                n_expected is the observed density times the model solid angle
+                (only if the model table has n{lim} columns)
+    """
+    model_counts = read_model_counts(model_counts)
+    if ogle_surfdens is None:
+        import fetch_data
+        ogle_surfdens = fetch_data.ogle_mroz2019()[0]
+    if maglims is None:
+        maglims = count_limits(model_counts, ogle_surfdens)
+    maglims = [f'{lim:g}' if not isinstance(lim, str) else lim for lim in maglims]
+
+    model_cols = [f'sigma{lim}' for lim in maglims] + [f'n{lim}' for lim in maglims
+                                                      if f'n{lim}' in model_counts.columns]
+    model_cols += [col for col in ['l', 'b'] if col in model_counts.columns]
+    obs_cols = [f'sigma{lim}' for lim in maglims] + [col for col in ['GLON', 'GLAT']
+                                                     if col in ogle_surfdens.columns]
+    joined = pd.merge(model_counts[model_cols], ogle_surfdens[obs_cols], how='inner',
+                      left_index=True, right_index=True, suffixes=('_model', '_obs'),
+                      validate='one_to_one')
+    if 'l' not in joined.columns:
+        joined['l'], joined['b'] = joined['GLON'], joined['GLAT']
+
+    out = joined[['l', 'b']].copy()
+    for lim in maglims:
+        mod = joined[f'sigma{lim}_model'].to_numpy(dtype=float)
+        obs = joined[f'sigma{lim}_obs'].to_numpy(dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = mod/obs
+            out[f'sigma{lim}_model'] = mod
+            out[f'sigma{lim}_obs'] = obs
+            out[f'ratio{lim}'] = ratio
+            out[f'logratio{lim}'] = np.log10(ratio)
+            out[f'frac{lim}'] = ratio-1
+            if f'n{lim}' in joined.columns:
+                n_mod = joined[f'n{lim}'].to_numpy(dtype=float)
+                # n/sigma is the model solid angle in arcmin^2
+                n_exp = obs*n_mod/mod
+                out[f'z{lim}'] = (n_mod-n_exp)/np.sqrt(n_exp)
+    out.index.name = model_counts.index.name
+    return out
+
+def count_stats(joined, maglims=None, by=None):
+    """
+    Summary statistics of the model/observed comparison.
+    inputs:
+        joined: output of join_counts
+        maglims: limits to summarize (default: all in joined)
+        by: optional grouping of the subfields (a column name, or an array
+            such as the field name of each subfield)
+    output:
+        DataFrame with one row per limit (per group and limit if by is given):
+        n, median and mean ratio, mean and standard deviation of the log ratio,
+        robust (MAD) scatter of the log ratio, rms fractional residual, fraction
+        of subfields within 10% and 30%, and chi2/n of the Poisson residuals
+    """
+    if maglims is None:
+        maglims = [col[5:] for col in joined.columns if col.startswith('ratio')]
+    rows = []
+    for lim in maglims:
+        df = pd.DataFrame({'lim':lim, 'ratio':joined[f'ratio{lim}'],
+                           'logratio':joined[f'logratio{lim}'], 'frac':joined[f'frac{lim}']},
+                          index=joined.index)
+        df['z2'] = joined[f'z{lim}']**2 if f'z{lim}' in joined.columns else np.nan
+        df = df[np.isfinite(df['logratio'])]
+        if by is not None:
+            df['group'] = joined.loc[df.index, by] if isinstance(by, str) else \
+                pd.Series(np.asarray(by), index=joined.index)[df.index]
+        rows.append(df)
+    df = pd.concat(rows)
+    keys = ['lim'] if by is None else ['group', 'lim']
+    df['abs_logdev'] = (df['logratio']-df.groupby(keys)['logratio'].transform('median')).abs()
+    df['frac2'] = df['frac']**2
+    df['within10'] = df['frac'].abs()<0.1
+    df['within30'] = df['frac'].abs()<0.3
+    stats = df.groupby(keys, sort=False).agg(n=('ratio', 'size'), median_ratio=('ratio', 'median'),
+                                             mean_ratio=('ratio', 'mean'),
+                                             mean_logratio=('logratio', 'mean'),
+                                             std_logratio=('logratio', 'std'),
+                                             mad_logratio=('abs_logdev', 'median'),
+                                             rms_frac=('frac2', 'mean'),
+                                             within10=('within10', 'mean'),
+                                             within30=('within30', 'mean'),
+                                             chi2_per_n=('z2', 'mean'))
+    stats['mad_logratio'] *= 1.4826
+    stats['rms_frac'] = np.sqrt(stats['rms_frac'])
+    return stats
+
+def map_data(table, column, cache_file='data/ogle_geometry.npz'):
+    """
+    Subfield outlines and values of one column, for a PatchCollection map.
+    inputs:
+        table: DataFrame indexed by subfield name (e.g. join_counts output,
+            the Mroz et al. 2019 table or model counts)
+        column: column to map
+        cache_file: ogle_geometry index cache
+    output:
+        (vertices (n, 4, 2) in Galactic l, b, values) for the subfields of
+        table known to the geometry index with a finite value
+    """
+    index = _geometry_index(cache_file)
+    codes = ogle_geometry.subfield_codes(table.index.to_numpy(), index)
+    values = table[column].to_numpy(dtype=float)
+    ok = (codes>=0) & np.isfinite(values)
+    return ogle_geometry.subfield_polygons(index, codes[ok]), values[ok]
+
+def compare_ogle_starcounts(model_counts='outputfiles/ogle_sim_surfdens.csv', ogle_surfdens=None,
+                            maglims=None, by=None):
+    """
+    Compare model star counts with the OGLE-IV subfield surface densities.
+    inputs:
+        model_counts: DataFrame or csv file of model counts (see read_model_counts)
+        ogle_surfdens: observed table (default: fetch_data.ogle_mroz2019()[0])
+        maglims: limits to compare (default: all in both tables)
+        by: optional grouping for the statistics (see count_stats)
+    output:
+        (joined table, statistics)
+    """
+    joined = join_counts(model_counts, ogle_surfdens, maglims)
+    return joined, count_stats(joined, by=by)
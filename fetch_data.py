@@ -1,44 +1,223 @@
+"""
+Module to fetch (and cache) the observational data sets used in the evaluations.
+
+Downloads run concurrently in a thread pool, are written atomically, and
+are checked against a checksum manifest (checksums.json in each data
+directory), so missing, empty or corrupt files are fetched again while good
+files are left alone. Parsed tables are cached next to their source files
+as .npz, keyed by the source checksum, so warm starts skip parsing text;
+gzipped files are parsed directly from the compressed stream.
+url_base may also be a file:// mirror for working offline.
+Current options are:
+    ogle_mroz2019()
+    ogle_ews_mapdat(event_list)
+    get_aasjournals_table(file_name, location, url_base)
+    get_aasjournals_frames(file_names, location, url_base)
+    fetch_files(files, location, url_base)
+"""
+
 import os
-from astropy.table import Table
-from urllib.request import urlretrieve
+import json
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import urlopen
+import numpy as np
 import pandas as pd
-import gzip
-import shutil
+from astropy.table import Table
+
+manifest_name = 'checksums.json'
+_manifest_lock = threading.Lock()
+
+def file_sha256(fname):
+    """
+    SHA-256 checksum of a file.
+    """
+    h = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(1<<20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _read_manifest(location):
+    try:
+        with open(os.path.join(location, manifest_name)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def _write_manifest(location, manifest):
+    tmp = os.path.join(location, f'{manifest_name}.{os.getpid()}.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, os.path.join(location, manifest_name))
+
+def _download(url, dest, timeout=60):
+    # Stream to a temporary file and only move it into place once complete
+    tmp = f'{dest}.{os.getpid()}.{threading.get_ident()}.tmp'
+    h = hashlib.sha256()
+    size = 0
+    try:
+        with urlopen(url, timeout=timeout) as resp, open(tmp, 'wb') as f:
+            for chunk in iter(lambda: resp.read(1<<20), b''):
+                h.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+        if size==0:
+            raise OSError(f'Empty download from {url}')
+        os.replace(tmp, dest)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return {'url':url, 'size':size, 'sha256':h.hexdigest()}
+
+def _is_intact(path, entry, verify):
+    if not os.path.isfile(path) or os.path.getsize(path)==0:
+        return False
+    if entry is None:
+        return True
+    if os.path.getsize(path)!=entry['size']:
+        return False
+    return not verify or file_sha256(path)==entry['sha256']
+
+def fetch_files(files, location, url_base, n_threads=8, verify=True):
+    """
+    Make sure a set of files is present and intact, downloading the others concurrently.
+    inputs:
+        files: file names (relative to both url_base and location), or
+            (remote name, local name) pairs
+        location: local data directory (created if needed)
+        url_base: base URL (http(s):// or file://)
+        n_threads: number of concurrent downloads
+        verify: if True, check existing files against the checksum manifest;
+            otherwise only their presence and size are checked
+    output:
+        list of local file paths
+    """
+    pairs = [(f, f) if isinstance(f, str) else tuple(f) for f in files]
+    os.makedirs(location, exist_ok=True)
+    manifest = _read_manifest(location)
+    todo, adopted = [], False
+    for remote, local in pairs:
+        path = os.path.join(location, local)
+        entry = manifest.get(local)
+        if _is_intact(path, entry, verify):
+            if entry is None:
+                # Files fetched before the manifest existed are adopted as they are
+                manifest[local] = {'url':url_base+remote, 'size':os.path.getsize(path),
+                                   'sha256':file_sha256(path)}
+                adopted = True
+            continue
+        todo.append((url_base+remote, local, path))
+
+    errors = []
+    if len(todo)>0:
+        with ThreadPoolExecutor(max(1, min(n_threads, len(todo)))) as pool:
+            futures = [(local, url, pool.submit(_download, url, path)) for url, local, path in todo]
+            for local, url, fut in futures:
+                try:
+                    manifest[local] = fut.result()
+                except Exception as e:
+                    errors.append(f'{url}: {type(e).__name__}: {e}')
+    if len(todo)>0 or adopted:
+        with _manifest_lock:
+            _write_manifest(location, {**_read_manifest(location), **manifest})
+    if errors:
+        raise OSError('Failed to fetch:\n'+'\n'.join(errors))
+    return [os.path.join(location, local) for _, local in pairs]
+
+def _save_frame(fname, df, source_sha):
+    arrays, dtypes = {}, []
+    for i,col in enumerate(df.columns):
+        series = df[col]
+        dtypes.append(str(series.dtype))
+        if isinstance(series.dtype, np.dtype) and series.dtype!=object:
+            arr = series.to_numpy()
+        elif pd.api.types.is_numeric_dtype(series.dtype):
+            # Nullable (masked) integer columns are stored as float with NaN
+            arr = series.to_numpy(dtype=float, na_value=np.nan)
+        else:
+            arr = series.astype(str).to_numpy().astype(str)
+        arrays['c'+str(i)] = arr
+    index = df.index.to_numpy()
+    tmp = fname[:-4]+f'.{os.getpid()}.tmp.npz'
+    np.savez(tmp, __columns__=np.array([str(col) for col in df.columns]), __dtypes__=np.array(dtypes),
+             __index__=index.astype(str) if index.dtype==object else index,
+             __index_name__=np.array('' if df.index.name is None else str(df.index.name)),
+             __source__=np.array(source_sha), **arrays)
+    os.replace(tmp, fname)
+
+def _load_frame(fname, source_sha):
+    # Cached table, or None if missing or built from a different source file
+    if not os.path.isfile(fname):
+        return None
+    try:
+        with np.load(fname, allow_pickle=False) as npz:
+            if str(npz['__source__'])!=source_sha:
+                return None
+            data = {}
+            for i,(col,dtype) in enumerate(zip(npz['__columns__'], npz['__dtypes__'])):
+                series = pd.Series(npz['c'+str(i)])
+                data[str(col)] = series if str(series.dtype)==dtype else series.astype(dtype)
+            index_name = str(npz['__index_name__'])
+            index = pd.Index(npz['__index__'], name=index_name if index_name else None)
+    except (OSError, ValueError, KeyError):
+        return None
+    df = pd.DataFrame(data)
+    df.index = index
+    return df
+
+def cached_frame(path, parse, location):
+    """
+    Parse a fetched file into a DataFrame, reusing the .npz cache next to it when
+    the file's checksum is unchanged.
+    inputs:
+        path: local file (as returned by fetch_files)
+        parse: function of the path returning a DataFrame
+        location: data directory holding the checksum manifest
+    """
+    entry = _read_manifest(location).get(os.path.relpath(path, location))
+    source_sha = entry['sha256'] if entry is not None else file_sha256(path)
+    cache_file = path+'.npz'
+    df = _load_frame(cache_file, source_sha)
+    if df is None:
+        df = parse(path)
+        _save_frame(cache_file, df, source_sha)
+    return df
 
 # Load machine readable table from AAS journals, downloading first if needed
 def get_aasjournals_table(file_name, location, url_base):
-    try:
-        data = Table.read(location+file_name, format="ascii.cds")
-    except:
-        if not os.path.isdir(location):
-            os.mkdir(location)
-        urlretrieve(url_base+file_name, location+file_name)
-        data = Table.read(location+file_name, format="ascii.cds")
-    return data
+    path = fetch_files([file_name], location, url_base)[0]
+    return Table.read(path, format="ascii.cds")
+
+# Load machine readable tables from AAS journals as DataFrames, cached in binary form
+def get_aasjournals_frames(file_names, location, url_base, index=None):
+    paths = fetch_files(file_names, location, url_base)
+    parse = lambda p: Table.read(p, format="ascii.cds").to_pandas(index=index)
+    return [cached_frame(path, parse, location) for path in paths]
 
 def ogle_mroz2019(location='data/apjsab426b/',
                      url_base='https://content.cld.iop.org/journals/0067-0049/244/2/29/revision1/'):
-    tab_surf_dens = get_aasjournals_table('apjsab426bt5_mrt.txt', location, url_base).to_pandas(index='field')
-    tab_fields = get_aasjournals_table('apjsab426bt6_mrt.txt', location, url_base).to_pandas(index='field')
-    tab_rates = get_aasjournals_table('apjsab426bt7_mrt.txt', location, url_base).to_pandas(index='field')
+    tab_surf_dens, tab_fields, tab_rates = get_aasjournals_frames(
+        ['apjsab426bt5_mrt.txt', 'apjsab426bt6_mrt.txt', 'apjsab426bt7_mrt.txt'],
+        location, url_base, index='field')
     return tab_surf_dens, tab_fields, tab_rates
 
-def ogle_ews_mapdat(event_list=['OGLE-2025-BLG-0467', 'OGLE-2025-BLG-0127', 'OGLE-2025-BLG-0412', 'OGLE-2025-BLG-0110'], 
+def _read_mapdat(path):
+    # Parsed straight from the gzip stream, without a decompressed copy on disk
+    return pd.read_csv(path, sep=r'\s+', usecols=[3,5], header=None, names=['V','I'], compression='gzip')
+
+def ogle_ews_mapdat(event_list=['OGLE-2025-BLG-0467', 'OGLE-2025-BLG-0127', 'OGLE-2025-BLG-0412', 'OGLE-2025-BLG-0110'],
                       location='data/ogle_ews_cmds/',
                       url_base='https://www.astrouw.edu.pl/ogle/ogle4/ews/'):
-    data_dict = {}
+    files = []
     for event_name in event_list:
-        try:
-            data_dict[event_name] = pd.read_csv(location+event_name+'_map.dat', sep='\s+', usecols=[3,5],header=None, names=['V','I'])
-        except:
-            if not os.path.isdir(location):
-                os.mkdir(location)
-            name_pts = event_name.split('-')
-            ogle_location = name_pts[1]+'/'+name_pts[2].lower()+'-'+name_pts[3]+'/'
-            urlretrieve(url_base+ogle_location+'map.dat.gz', location+event_name+'_map.dat.gz')
-            urlretrieve(url_base+ogle_location+'params.dat', location+event_name+'_params.dat')
-            with gzip.open(location+event_name+'_map.dat.gz', 'rb') as f_in:
-                with open(location+event_name+'_map.dat', 'wb') as f_out:
-                    shutil.copyfileobj(f_in, f_out)
-            data_dict[event_name] = pd.read_csv(location+event_name+'_map.dat', sep='\s+', usecols=[3,5],header=None, names=['V','I'])
-    return data_dict
\ No newline at end of file
+        name_pts = event_name.split('-')
+        ogle_location = name_pts[1]+'/'+name_pts[2].lower()+'-'+name_pts[3]+'/'
+        files.append((ogle_location+'map.dat.gz', event_name+'_map.dat.gz'))
+        files.append((ogle_location+'params.dat', event_name+'_params.dat'))
+    paths = fetch_files(files, location, url_base)
+    data_dict = {}
+    for event_name, path in zip(event_list, paths[::2]):
+        data_dict[event_name] = cached_frame(path, _read_mapdat, location)
+    return data_dict
@@ -0,0 +1,447 @@
+"""
+Parallel, resumable driver for generating SynthPop catalogs over a grid of
+fields (e.g. the OGLE-IV subfields listed in subfs_inmap.csv).
+
+Fields are spread over a process pool, with one initialized SynthPop model
+per worker and configuration. Every finished (configuration, field) pair is
+appended to a manifest file together with a hash of the configuration's
+keyword arguments, so a rerun after a crash skips all fields that were
+already written with the same settings. Several configurations (e.g. the OGLE lens and source
+catalogs) can be run side by side in the same pool.
+
+Rather than guessing each field's solid angle from the previous field's
+star count (and regenerating when the guess misses), the solid angles can
+be predicted up front from a stellar density estimate: either a cheap,
+cached low-solid-angle pre-pass over the grid ('prepass') or the observed
+OGLE-IV I<21 surface densities of Mroz et al. 2019 ('ogle', scaled for
+configurations with other magnitude limits by a pre-pass over a few
+calibration fields). Each field
+then needs a single full-size process_location call.
+
+Usage:
+    flds = pd.read_csv('subfs_inmap.csv')
+    run_fields(flds, {'lens': ogle_lens_kwargs, 'src': ogle_src_kwargs},
+               solang_method='prepass')
+"""
+
+import os
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+import instrument
+
+# Target range for the number of stars per field catalog
+ulim = 10000
+llim = 3000
+alim = 4000
+
+ogle_bands = ["Bessell_U", "Bessell_B", "Bessell_V", "Bessell_R", "Bessell_I",
+              "2MASS_J", "2MASS_H", "2MASS_Ks"]
+
+# SynthPop settings for the OGLE chip lens catalogs
+ogle_lens_kwargs = dict(default_config='huston2025_defaults.synthpop_conf',
+                        maglim=["Bessell_I", 99, "keep"],
+                        chosen_bands=ogle_bands,
+                        post_processing_kwargs=[{"name":"ProcessDarkCompactObjects", "remove":False}],
+                        name_for_output="Huston2025",
+                        output_location="outputfiles/ogle_chips/lens",
+                        output_file_type="h5")
+
+# SynthPop settings for the OGLE chip source catalogs
+ogle_src_kwargs = dict(default_config='huston2025_defaults.synthpop_conf',
+                       maglim=["Bessell_I", 21, "remove"],
+                       chosen_bands=ogle_bands,
+                       post_processing_kwargs=[{"name":"ProcessDarkCompactObjects", "remove":True}],
+                       name_for_output="Huston2025",
+                       output_location="outputfiles/ogle_chips/src",
+                       skip_lowmass_stars=True,
+                       output_file_type="h5")
+
+manifest_cols = ['config', 'field', 'l', 'b', 'solid_angle', 'n_stars', 'n_runs', 'kwargs_hash']
+density_cols = ['config', 'field', 'l', 'b', 'density']
+
+# Solid angles are passed to process_location in its default unit (sr)
+arcmin2_per_sr = (180*60/np.pi)**2
+
+# Per-process state, filled in lazily inside each worker
+_configs = {}
+_models = {}
+_solangs = {}
+
+def init_worker(configs, solang):
+    """
+    Process pool initializer: register SynthPop configurations in a worker.
+    inputs:
+        configs: dictionary of {configuration name: SynthPop keyword arguments}
+        solang: starting solid angle estimate (sr) for each configuration
+    """
+    _configs.update(configs)
+    for name in configs:
+        _solangs[name] = solang
+
+def get_model(name):
+    """
+    Initialized SynthPop model of a configuration registered with init_worker,
+    created on first use so each worker only initializes the configurations
+    it is actually handed.
+    """
+    if name not in _models:
+        import synthpop as sp
+        with instrument.span('model_init', config=name):
+            mod = sp.SynthPop(**_configs[name])
+            mod.init_populations()
+        _models[name] = mod
+    return _models[name]
+
+def imap_unordered(pool, func, jobs):
+    """
+    Results of func for each job from a ProcessPoolExecutor, as they finish.
+    Jobs not yet started are cancelled if the caller stops early (an error
+    or interrupt), so leaving the pool does not wait for the whole queue.
+    A worker that dies raises BrokenProcessPool.
+    """
+    futures = [pool.submit(func, job) for job in jobs]
+    try:
+        for fut in as_completed(futures):
+            yield fut.result()
+    finally:
+        for fut in futures:
+            fut.cancel()
+
+def _run_field(job):
+    """
+    Generate one field catalog, rerunning once with a rescaled solid angle
+    if the star count falls outside [llim, ulim]. Uses the predicted solid
+    angle if the job carries one, else the worker's running estimate.
+    """
+    name, field, l, b, solang = job
+    mod = get_model(name)
+    if solang is None or not np.isfinite(solang):
+        solang = _solangs[name]
+    with instrument.span('process_location', config=name, field=field, l=l, b=b,
+                         solid_angle=solang, attempt=1) as sp:
+        df1,_ = mod.process_location(l_deg=l, b_deg=b, solid_angle=solang)
+        sp.rows = len(df1)
+    leng = len(df1)
+    n_runs = 1
+    if leng>ulim or leng<llim:
+        print('    length:',leng,", rerunning l=",l,' b=',b, flush=True)
+        solang = solang * alim/max(leng,1)
+        with instrument.span('process_location_rerun', config=name, field=field, l=l, b=b,
+                             solid_angle=solang, attempt=2) as sp:
+            df1,_ = mod.process_location(l_deg=l, b_deg=b, solid_angle=solang)
+            sp.rows = len(df1)
+        leng = len(df1)
+        n_runs += 1
+    _solangs[name] = solang * alim/max(leng,1)
+    return [name, field, l, b, solang, leng, n_runs]
+
+def _prepass_field(job):
+    # Low solid angle run giving stars per unit solid angle for one field
+    name, field, l, b, pre_solang = job
+    mod = get_model(name)
+    with instrument.span('prepass', config=name, field=field, l=l, b=b, solid_angle=pre_solang) as sp:
+        df1,_ = mod.process_location(l_deg=l, b_deg=b, solid_angle=pre_solang, save_data=False)
+        sp.rows = len(df1)
+    return [name, field, l, b, len(df1)/pre_solang]
+
+def kwargs_hash(kwargs):
+    """
+    Short hash of a configuration's SynthPop keyword arguments, recorded per
+    field so that catalogs generated with other settings are not reused.
+    """
+    return hashlib.sha1(json.dumps(kwargs, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+def read_manifest(manifest_file):
+    """
+    Return the manifest of finished fields as a DataFrame, keeping the last
+    record of each (config, field) pair (empty if no manifest has been written yet).
+    """
+    if os.path.isfile(manifest_file) and os.path.getsize(manifest_file)>0:
+        man = pd.read_csv(manifest_file, dtype={'config':str, 'field':str, 'kwargs_hash':str})
+        # Manifests written before kwargs were recorded never match, so those fields are regenerated
+        if 'kwargs_hash' not in man.columns:
+            man['kwargs_hash'] = ''
+        man['kwargs_hash'] = man['kwargs_hash'].fillna('')
+        return man.drop_duplicates(['config', 'field'], keep='last')[manifest_cols].reset_index(drop=True)
+    return pd.DataFrame(columns=manifest_cols)
+
+def _write_manifest(manifest_file, man):
+    tmp = manifest_file+f'.{os.getpid()}.tmp'
+    man.to_csv(tmp, index=False)
+    os.replace(tmp, manifest_file)
+
+def needs_header(csv_file):
+    """
+    True if csv_file is missing or empty, so appended rows need a header line first.
+    A file holding only a header (e.g. after an interrupted run) already has one.
+    """
+    return not os.path.isfile(csv_file) or os.path.getsize(csv_file)==0
+
+def field_ids(flds):
+    """
+    Field identifiers: the 'field' column if present, else the index.
+    """
+    if 'field' in flds.columns:
+        return flds['field'].astype(str).to_numpy()
+    return flds.index.astype(str).to_numpy()
+
+def finished_pairs(done, hashes=None):
+    """
+    Set of (config, field) pairs in the manifest, counting only records made
+    with the current kwargs hash of their config if hashes ({config name: hash}) is given.
+    """
+    if done is None or len(done)==0:
+        return set()
+    if hashes is not None:
+        done = done[done['kwargs_hash'].astype(str).to_numpy()==done['config'].map(hashes).to_numpy()]
+    return set(zip(done['config'].astype(str), done['field'].astype(str)))
+
+def field_jobs(flds, config_names, done=None, solangs=None, hashes=None):
+    """
+    Build the (config, field, l, b, solid angle) job list for a table of
+    fields with GLON/GLAT columns, skipping pairs already in the manifest
+    (with the same kwargs hash, if hashes is given; see finished_pairs).
+    solangs optionally maps config name -> array of predicted solid angles
+    aligned with flds; otherwise the solid angle is left to the worker.
+    """
+    ids = field_ids(flds)
+    ls, bs = flds['GLON'].to_numpy(), flds['GLAT'].to_numpy()
+    finished = finished_pairs(done, hashes)
+    # Interleave configurations so lens and src catalogs progress together
+    jobs = []
+    for i in range(len(ids)):
+        for name in config_names:
+            if (name, ids[i]) not in finished:
+                solang = None
+                if solangs is not None and name in solangs:
+                    solang = float(solangs[name][i])
+                jobs.append((name, ids[i], float(ls[i]), float(bs[i]), solang))
+    return jobs
+
+def read_densities(cache_file):
+    """
+    Return the cached pre-pass densities as a DataFrame
+    (empty if the cache has not been written yet).
+    """
+    if os.path.isfile(cache_file) and os.path.getsize(cache_file)>0:
+        return pd.read_csv(cache_file, dtype={'config':str, 'field':str})
+    return pd.DataFrame(columns=density_cols)
+
+def _lookup_densities(flds, dens, name):
+    # Match cached densities to flds by field id, falling back on rounded (l,b)
+    ids = field_ids(flds)
+    sub = dens[dens['config']==name]
+    by_id = dict(zip(sub['field'], sub['density']))
+    by_lb = dict(zip(zip(np.round(sub['l'].astype(float),3), np.round(sub['b'].astype(float),3)),
+                     sub['density']))
+    lbs = zip(np.round(flds['GLON'].to_numpy(),3), np.round(flds['GLAT'].to_numpy(),3))
+    return np.array([by_id.get(f, by_lb.get(lb, np.nan)) for f,lb in zip(ids, lbs)], dtype=float)
+
+def prepass_densities(flds, configs, n_proc=None, pre_solang=1e-6,
+                      cache_file='outputfiles/ogle_chips/prepass_densities.csv'):
+    """
+    Estimate the number of stars per unit solid angle (sr) for every field
+    and configuration from a low solid angle pre-pass. Results are cached
+    on disk by (config, field, l, b), so the pre-pass is only run once per grid.
+    inputs:
+        flds: DataFrame of fields with GLON, GLAT (and optionally field) columns
+        configs: dictionary of {config name: SynthPop keyword arguments}
+        n_proc: number of worker processes (default: all cores)
+        pre_solang: pre-pass solid angle (sr); ~10x below the full-size catalogs
+        cache_file: csv file of cached densities
+    output:
+        dictionary of {config name: array of densities aligned with flds}
+    """
+    cache_dir = os.path.dirname(cache_file)
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+    dens = read_densities(cache_file)
+    ids = field_ids(flds)
+    jobs = []
+    for name in configs:
+        known = _lookup_densities(flds, dens, name)
+        for i in np.where(np.isnan(known))[0]:
+            jobs.append((name, ids[i], float(flds['GLON'].iloc[i]), float(flds['GLAT'].iloc[i]),
+                         pre_solang))
+    if len(jobs)>0:
+        print(f'Density pre-pass for {len(jobs)} fields', flush=True)
+        if n_proc is None:
+            n_proc = os.cpu_count()
+        n_proc = max(1, min(n_proc, len(jobs)))
+        write_header = needs_header(cache_file)
+        with open(cache_file, 'a') as f_cache, \
+             ProcessPoolExecutor(n_proc, initializer=init_worker, initargs=(configs, pre_solang)) as pool:
+            if write_header:
+                f_cache.write(','.join(density_cols)+'\n')
+            for row in imap_unordered(pool, _prepass_field, jobs):
+                f_cache.write(','.join(str(x) for x in row)+'\n')
+                f_cache.flush()
+        dens = read_densities(cache_file)
+    return {name: _lookup_densities(flds, dens, name) for name in configs}
+
+def ogle_densities(flds, scale=1.0):
+    """
+    Stars per unit solid angle (sr) for each field from the observed OGLE-IV
+    I<21 surface densities (sigma21, Mroz et al. 2019), matched on subfield id.
+    Suited to I<21 source catalogs; scale converts to other magnitude limits.
+    """
+    import fetch_data
+    ogle_surfdens = fetch_data.ogle_mroz2019()[0]
+    sigma21 = ogle_surfdens['sigma21'].reindex(field_ids(flds)).to_numpy(dtype=float)
+    return sigma21 * arcmin2_per_sr * scale
+
+def matches_ogle_limit(config):
+    """
+    True if a SynthPop configuration keeps only I<21 stars, i.e. the sample
+    the OGLE-IV sigma21 surface densities count.
+    """
+    maglim = config.get('maglim')
+    return (maglim is not None and maglim[0]=='Bessell_I' and float(maglim[1])==21
+            and maglim[2]=='remove')
+
+def ogle_config_densities(flds, configs, n_calib=20, n_proc=None, pre_solang=1e-6,
+                          cache_file='outputfiles/ogle_chips/prepass_densities.csv'):
+    """
+    Stars per sr for every configuration from the OGLE-IV I<21 densities.
+    Configurations keeping only I<21 stars use them directly. For any other
+    configuration (e.g. the lens catalogs, which keep all stars) they are
+    scaled by the median ratio of pre-pass to OGLE density over n_calib
+    fields spread through the grid, so only those fields need a pre-pass.
+    output:
+        dictionary of {config name: array of densities aligned with flds}
+    """
+    base = ogle_densities(flds)
+    out = {name: base for name in configs if matches_ogle_limit(configs[name])}
+    other = {name: configs[name] for name in configs if name not in out}
+    if len(other)>0:
+        has_obs = np.flatnonzero(np.isfinite(base) & (base>0))
+        calib = has_obs[np.unique(np.linspace(0, len(has_obs)-1, min(n_calib, len(has_obs))).astype(int))]
+        pre = prepass_densities(flds.iloc[calib], other, n_proc=n_proc, pre_solang=pre_solang,
+                                cache_file=cache_file)
+        for name in other:
+            ratio = np.nanmedian(pre[name]/base[calib])
+            print(f'{name}: density {ratio:.3g} x OGLE I<21 (median of {len(calib)} fields)', flush=True)
+            out[name] = base*ratio
+    return out
+
+def predict_solid_angles(densities, n_target=alim):
+    """
+    Convert densities (stars per sr) into solid angles giving n_target stars.
+    Fields without a valid density get NaN, i.e. fall back to the adaptive guess.
+    """
+    dens = np.asarray(densities, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        solang = n_target / dens
+    solang[~np.isfinite(solang) | (dens<=0)] = np.nan
+    return solang
+
+def report_regenerations(manifest, flds=None, logged=None):
+    """
+    Report the regenerations (second process_location calls) per config.
+    The actual count comes from the manifest's n_runs (and, if logged is given,
+    from the reruns recorded in this run's instrument log); it is compared with
+    an estimate of how many fields the previous-field solid angle scheme
+    would have regenerated, given the realized densities in field order.
+    inputs:
+        manifest: manifest DataFrame (see read_manifest)
+        flds: optional field table giving the field order
+        logged: optional {config name: reruns logged in this run}
+    output:
+        dictionary of {config name: {'fields', 'regenerated', 'regenerated_this_run',
+                                     'previous_field_estimate'}}
+    """
+    report = {}
+    for name, sub in manifest.groupby('config'):
+        if flds is not None:
+            order = {f:i for i,f in enumerate(field_ids(flds))}
+            sub = sub.assign(_order=sub['field'].map(order)).sort_values('_order')
+        dens = sub['n_stars'].to_numpy(dtype=float) / sub['solid_angle'].to_numpy(dtype=float)
+        n_guess = dens[1:] * alim / dens[:-1]
+        would = int(np.sum((n_guess>ulim) | (n_guess<llim)))
+        actual = int(np.sum(sub['n_runs'].to_numpy(dtype=int)-1))
+        this_run = None if logged is None else int(logged.get(name, 0))
+        report[name] = {'fields':len(sub), 'regenerated':actual, 'regenerated_this_run':this_run,
+                        'previous_field_estimate':would}
+        msg = f'{name}: {actual} of {len(sub)} fields regenerated'
+        if this_run is not None:
+            msg += f' ({this_run} in this run)'
+        print(msg+f'; previous-field sizing would have regenerated about {would}', flush=True)
+    return report
+
+def run_fields(flds, configs, n_proc=None, manifest_file='outputfiles/ogle_chips/manifest.csv',
+               solang=1e-5, solang_method=None, densities=None, log_file=None):
+    """
+    Generate catalogs for every field in flds for each SynthPop configuration.
+    inputs:
+        flds: DataFrame of fields with GLON, GLAT (and optionally field) columns
+        configs: dictionary of {config name: SynthPop keyword arguments}
+        n_proc: number of worker processes (default: all cores)
+        manifest_file: csv file recording finished fields; reruns skip them unless
+            the config's keyword arguments (kwargs_hash) have changed
+        solang: initial solid angle guess (sr) for each worker
+        solang_method: None (adaptive, previous-field guess), 'prepass' or 'ogle'
+            to predict each field's solid angle before generation ('ogle' is
+            calibrated per config, see ogle_config_densities)
+        densities: optional {config name: densities (stars/sr) aligned with flds},
+            overriding solang_method
+        log_file: per-field timing/memory log (JSON lines, see instrument);
+            default instrument.jsonl next to the manifest
+    output:
+        DataFrame manifest of all finished fields
+    """
+    manifest_dir = os.path.dirname(manifest_file)
+    if manifest_dir:
+        os.makedirs(manifest_dir, exist_ok=True)
+    if log_file is None:
+        log_file = os.path.join(manifest_dir, 'instrument.jsonl')
+    run_id = instrument.set_log(log_file)
+    done = read_manifest(manifest_file)
+    hashes = {name: kwargs_hash(kwargs) for name, kwargs in configs.items()}
+    if not needs_header(manifest_file) and pd.read_csv(manifest_file, nrows=0).columns.tolist()!=manifest_cols:
+        # Older manifest layout: rewrite it so appended rows match the header
+        _write_manifest(manifest_file, done)
+    if densities is None and solang_method=='prepass':
+        densities = prepass_densities(flds, configs, n_proc=n_proc,
+                        cache_file=os.path.join(manifest_dir, 'prepass_densities.csv'))
+    elif densities is None and solang_method=='ogle':
+        densities = ogle_config_densities(flds, configs, n_proc=n_proc,
+                        cache_file=os.path.join(manifest_dir, 'prepass_densities.csv'))
+    elif densities is None and solang_method is not None:
+        raise ValueError(f'Unknown solang_method: {solang_method}')
+    solangs = None
+    if densities is not None:
+        solangs = {name: predict_solid_angles(densities[name]) for name in densities}
+    jobs = field_jobs(flds, list(configs.keys()), done, solangs, hashes)
+    n_done = len(finished_pairs(done, hashes))
+    n_stale = int(np.sum(done['config'].isin(list(hashes))))-n_done
+    print(f'{len(jobs)} field catalogs to generate, {n_done} already done', flush=True)
+    if n_stale>0:
+        print(f'{n_stale} finished fields were generated with other config kwargs', flush=True)
+    if len(jobs)==0:
+        return done
+
+    if n_proc is None:
+        n_proc = os.cpu_count()
+    n_proc = max(1, min(n_proc, len(jobs)))
+    write_header = needs_header(manifest_file)
+    # The parent process is the only manifest writer; one line per finished field
+    with open(manifest_file, 'a') as f_man, \
+         ProcessPoolExecutor(n_proc, initializer=init_worker, initargs=(configs, solang)) as pool:
+        if write_header:
+            f_man.write(','.join(manifest_cols)+'\n')
+        for n, row in enumerate(imap_unordered(pool, _run_field, jobs)):
+            row = row + [hashes[row[0]]]
+            f_man.write(','.join(str(x) for x in row)+'\n')
+            f_man.flush()
+            print(n, *row, flush=True)
+    done = read_manifest(manifest_file)
+    recs = instrument.records(log_file, run=run_id)
+    logged = {}
+    if len(recs)>0 and 'config' in recs.columns:
+        logged = recs[recs['stage']=='process_location_rerun'].groupby('config').size().to_dict()
+    report_regenerations(done, flds, logged)
+    instrument.summary(log_file, run=run_id)
+    return done
@@ -0,0 +1,110 @@
+"""
+Loader for the HST Bulge Treasury (WFC3-Bulge) photometric catalogs and
+artificial-star tests.
+
+Only the requested columns of the FITS tables are read, in chunks of rows,
+into preallocated arrays of the file's own precision (float32 magnitudes
+stay float32; only the byte order is made native). The first read of each
+file is converted into a catalog_store field, so repeat reads memory-map
+the columns instead of parsing FITS again; the conversion is redone if the
+FITS file changes or more columns are requested.
+
+Usage:
+    cats = load_fields('cat')        # observed catalogs of all four fields
+    arts = load_fields('art')        # artificial-star tests
+"""
+
+import os
+import numpy as np
+import pandas as pd
+import catalog_store
+
+fields = ['baade', 'ogle29', 'stanek', 'sweeps']
+field_names = ["Baade's Window", 'OGLE29 field', 'Stanek Window', 'SWEEPS Field']
+coords = {'baade':(1.06, -3.81), 'ogle29':(-6.75, -4.72), 'stanek':(0.25, -2.15), 'sweeps':(1.26, -2.65)}
+
+file_pattern = 'data/hst_bulge_treasury_obs/hlsp_wfc3bulge_hst_wfc3_{field}_multi_v2.0_{kind}.fits'
+default_store = 'data/hst_bulge_treasury_obs/store'
+default_columns = {'cat':['CMAG', 'VMAG', 'IMAG', 'JMAG', 'HMAG', 'RA', 'DEC', 'PPMX', 'PPMY'],
+                   'art':['CIN', 'COUT', 'VIN', 'VOUT', 'IIN', 'IOUT', 'JIN', 'JOUT', 'HIN', 'HOUT']}
+
+def read_fits_columns(fname, columns, ext=1, chunk_rows=1000000):
+    """
+    Read columns of a FITS binary table in chunks of rows.
+    inputs:
+        fname: FITS file
+        columns: column names (case-insensitive)
+        ext: table extension
+        chunk_rows: rows read per chunk
+    output:
+        DataFrame of the columns in native byte order and the file's precision;
+        single-element vector columns are flattened, and columns with more
+        than one element per row raise a ValueError
+    """
+    import fitsio
+    with fitsio.FITS(fname) as fits:
+        hdu = fits[ext]
+        n = hdu.get_nrows()
+        names = {name.upper():name for name in hdu.get_colnames()}
+        file_cols = [names[col.upper()] for col in columns]
+        out = None
+        for start in range(0, n, chunk_rows):
+            stop = min(start+chunk_rows, n)
+            chunk = hdu.read(columns=file_cols, rows=np.arange(start, stop))
+            if out is None:
+                for col, fc in zip(columns, file_cols):
+                    if np.prod(chunk.dtype[fc].shape, dtype=int)>1:
+                        raise ValueError(f'{fname}: column {col} holds arrays of shape {chunk.dtype[fc].shape}'
+                                         '; only scalar columns can be read')
+                out = {col: np.empty(n, dtype=chunk[fc].dtype.newbyteorder('=').base)
+                       for col, fc in zip(columns, file_cols)}
+            for col, fc in zip(columns, file_cols):
+                out[col][start:stop] = chunk[fc].reshape(stop-start)
+            del chunk
+    if out is None:
+        out = {col: np.array([]) for col in columns}
+    return pd.DataFrame(out, copy=False)
+
+def _store_location(kind, store_dir):
+    return os.path.join(store_dir, kind)
+
+def load_field(field, kind='cat', columns=None, where=None, store_dir=default_store,
+               file_pattern=file_pattern, chunk_rows=1000000, force=False):
+    """
+    Load one field's catalog ('cat') or artificial-star test ('art'), from the
+    memory-mapped store if it holds a current conversion, else from the FITS file.
+    inputs:
+        field: one of fields (e.g. 'stanek')
+        kind: 'cat' or 'art'
+        columns: columns to return (default: default_columns[kind])
+        where: optional cuts {column: (lo, hi)} applied in the store (see catalog_store.read_field)
+        store_dir: store location
+        chunk_rows: rows per chunk when converting
+        force: if True, reconvert the FITS file
+    output:
+        DataFrame
+    """
+    if columns is None:
+        columns = default_columns[kind]
+    columns = [col.upper() for col in columns]
+    fname = file_pattern.format(field=field, kind=kind)
+    l, b = coords[field]
+    store = _store_location(kind, store_dir)
+    if not force and catalog_store.is_current(fname, l, b, store):
+        try:
+            return catalog_store.read_field(l, b, store, columns=columns, where=where)
+        except KeyError:
+            # Column not in the stored conversion; convert again including it
+            pass
+    convert_cols = list(dict.fromkeys(default_columns[kind] + columns))
+    df = read_fits_columns(fname, convert_cols, chunk_rows=chunk_rows)
+    catalog_store.write_field(df, l, b, store, source=fname)
+    del df
+    return catalog_store.read_field(l, b, store, columns=columns, where=where)
+
+def load_fields(kind='cat', columns=None, use_fields=fields, **kwargs):
+    """
+    Load all (or the given) fields' catalogs or artificial-star tests, as a list
+    of DataFrames in the order of use_fields. kwargs are passed to load_field.
+    """
+    return [load_field(field, kind, columns, **kwargs) for field in use_fields]
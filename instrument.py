@@ -0,0 +1,165 @@
+"""
+Lightweight per-stage timing and memory instrumentation for the batch scripts.
+
+A span records the wall time, CPU time, peak resident memory and number of
+rows produced by one stage of work (model initialization, one
+process_location call, a file write, a rate calculation), together with
+any labels such as the field and (l,b). Records are kept in memory and, if a
+log file is set, appended as JSON lines. The log location is passed through
+the environment, so worker processes of a pool write to the same log. The
+summary table then shows where the time goes, and the slowest spans point
+out pathological fields.
+
+Usage:
+    instrument.set_log('outputfiles/ogle_chips/instrument.jsonl')
+    with instrument.span('process_location', field='BLG501.01', l=l, b=b) as sp:
+        df, _ = mod.process_location(l, b, solid_angle=solang)
+        sp.rows = len(df)
+    instrument.summary()
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import resource
+import functools
+import itertools
+import pandas as pd
+
+log_env = 'SYNTHPOP_INSTRUMENT_LOG'
+run_env = 'SYNTHPOP_INSTRUMENT_RUN'
+_records = []
+_run_counter = itertools.count()
+
+def set_log(log_file):
+    """
+    Append span records to log_file (JSON lines), also from worker processes
+    started afterwards; None stops logging to file. Starts a new run id.
+    output:
+        the run id, used to select this run's records in summary()
+    """
+    run_id = f'{time.strftime("%Y%m%dT%H%M%S")}-{os.getpid()}-{next(_run_counter)}'
+    os.environ[run_env] = run_id
+    if log_file is None:
+        os.environ.pop(log_env, None)
+        return run_id
+    log_dir = os.path.dirname(log_file)
+    if log_dir:
+        os.makedirs(log_dir, exist_ok=True)
+    os.environ[log_env] = log_file
+    return run_id
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process so far (MB).
+    """
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kB elsewhere
+    return maxrss/2**20 if sys.platform=='darwin' else maxrss/2**10
+
+def _emit(rec):
+    _records.append(rec)
+    log_file = os.environ.get(log_env)
+    if log_file:
+        # One write per record on an O_APPEND file, so concurrent workers do not interleave lines
+        fd = os.open(log_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, (json.dumps(rec, default=str)+'\n').encode())
+        finally:
+            os.close(fd)
+
+class span:
+    """
+    Context manager timing one stage of work.
+    inputs:
+        stage: stage name (e.g. 'process_location')
+        labels: extra keyword labels stored with the record (e.g. field, l, b)
+    Set .rows inside the block to record the number of rows produced; other
+    labels can be added with .labels[key] = value. Exceptions are recorded
+    (status 'error') and re-raised.
+    """
+    def __init__(self, stage, **labels):
+        self.stage = stage
+        self.labels = labels
+        self.rows = None
+
+    def __enter__(self):
+        self._rss0 = peak_rss_mb()
+        self._cpu0 = time.process_time()
+        self._wall0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter()-self._wall0
+        cpu = time.process_time()-self._cpu0
+        rss = peak_rss_mb()
+        rec = {'run':os.environ.get(run_env, ''), 'stage':self.stage, 'wall_s':wall, 'cpu_s':cpu,
+               'peak_rss_mb':rss, 'rss_growth_mb':rss-self._rss0, 'rows':self.rows,
+               'status':'ok' if exc_type is None else f'error: {exc_type.__name__}',
+               'pid':os.getpid(), 'host':socket.gethostname(), 'time':time.time(), **self.labels}
+        _emit(rec)
+        return False
+
+def timed(stage=None):
+    """
+    Decorator wrapping every call of a function in a span (named after the function by default).
+    """
+    def wrap(func):
+        name = stage if stage is not None else func.__name__
+        @functools.wraps(func)
+        def inner(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return inner
+    return wrap
+
+def records(log_file=None, run=None):
+    """
+    Span records as a DataFrame, from log_file if given (else this process's
+    records), optionally only those of one run id.
+    """
+    if log_file is not None:
+        if not os.path.isfile(log_file):
+            return pd.DataFrame()
+        with open(log_file) as f:
+            recs = [json.loads(line) for line in f if line.strip()]
+    else:
+        recs = list(_records)
+    df = pd.DataFrame(recs)
+    if run is not None and len(df)>0:
+        df = df[df['run']==run]
+    return df
+
+def summary(log_file=None, run=None, by='stage', n_slowest=5, show=True):
+    """
+    Summary table of the span records grouped by stage (or any other label).
+    inputs:
+        log_file, run: which records to use (see records)
+        by: label(s) to group by
+        n_slowest: number of slowest spans to list per stage (e.g. slow fields)
+        show: if True, print the tables
+    output:
+        (summary DataFrame, DataFrame of the slowest spans)
+    """
+    df = records(log_file if log_file is not None else os.environ.get(log_env), run)
+    if len(df)==0:
+        return pd.DataFrame(), pd.DataFrame()
+    df['rows'] = pd.to_numeric(df['rows'], errors='coerce')
+    df['failed'] = df['status']!='ok'
+    table = df.groupby(by).agg(n=('wall_s', 'size'), failed=('failed', 'sum'),
+                               wall_total_s=('wall_s', 'sum'), wall_mean_s=('wall_s', 'mean'),
+                               wall_max_s=('wall_s', 'max'), cpu_total_s=('cpu_s', 'sum'),
+                               peak_rss_mb=('peak_rss_mb', 'max'), rows=('rows', 'sum'))
+    table['wall_frac'] = table['wall_total_s']/table['wall_total_s'].sum()
+    table = table.sort_values('wall_total_s', ascending=False)
+    slowest = df.sort_values('wall_s', ascending=False).groupby(by).head(n_slowest)
+    label_cols = [c for c in df.columns if c not in ('run', 'pid', 'host', 'time', 'failed', 'cpu_s',
+                                                     'rss_growth_mb', 'status')]
+    slowest = slowest[label_cols]
+    if show:
+        with pd.option_context('display.width', 200, 'display.max_columns', 20):
+            print(table.to_string(float_format=lambda x: f'{x:.3g}'), flush=True)
+            print(f'\nSlowest spans:\n{slowest.to_string(index=False)}', flush=True)
+    return table, slowest
@@ -0,0 +1,206 @@
+"""
+Precomputed geometry index of the OGLE-IV fields and subfields (chips).
+
+The vertices of every field and of its 32 subfields are computed at once as
+NumPy arrays (the same vertices as ogle_utils.o4_field / o4_subfield), stored
+in both equatorial and Galactic coordinates, and cached on disk. The index
+also supports a vectorized lookup assigning any number of stars or events to
+their subfield: points are taken to equatorial coordinates, matched to the
+nearest field centres with a KD-tree, and placed on the chip layout with
+integer arithmetic in each field's pixel frame.
+
+Usage:
+    idx = load_index()
+    codes = assign_subfields(l, b, idx)
+    names = subfield_names(codes, idx)   # e.g. 'BLG501.01', '' if outside
+"""
+
+import os
+import hashlib
+import numpy as np
+from scipy.spatial import cKDTree
+import ogle_utils
+
+pix_deg = ogle_utils.PIXEL_SIZE / 3600.0
+n_chips = 32
+
+# Field outline in pixels (x along RA, y along Dec), as in ogle_utils.o4_field
+field_x = np.array([-7518, -7518, 7518, 7518, 9616, 9616, 7518, 7518, -7518, -7518, -9616, -9616], dtype=float)
+field_y = np.array([4321, 8610, 8610, 4321, 4321, -4321, -4321, -8610, -8610, -4321, -4321, 4321], dtype=float)
+
+# Chip rows: (first chip, number of chips, x of the first chip's high-x edge, y range)
+chip_rows = [(1, 7, 7468.0, -8610.0, -4508.0),
+             (8, 9, 9616.0, -4134.0, -32.0),
+             (17, 9, 9616.0, 32.0, 4134.0),
+             (26, 7, 7468.0, 4508.0, 8610.0)]
+chip_step = 2148.0
+chip_width = 2048.0
+
+def _chip_vertices():
+    # Vertex offsets (32, 4) in pixels for every chip, as in ogle_utils.o4_subfield
+    cx, cy = np.zeros((n_chips, 4)), np.zeros((n_chips, 4))
+    for first, n, x_hi, y_lo, y_hi in chip_rows:
+        for k in range(n):
+            x1 = x_hi - k*chip_step
+            # ogle_utils lists the top/bottom rows of chips in opposite vertex order
+            ys = [y_lo, y_hi, y_hi, y_lo] if y_hi<0 else [y_hi, y_lo, y_lo, y_hi]
+            cx[first-1+k] = [x1, x1, x1-chip_width, x1-chip_width]
+            cy[first-1+k] = ys
+    return cx, cy
+
+chip_x, chip_y = _chip_vertices()
+
+def galactic_to_equatorial(_l, _b):
+    """ Transforming Galactic to equatorial coordinates (inverse of ogle_utils.equatorial_to_galactic)"""
+    deg = np.pi/180.0
+    ra_g = 192.85948*deg
+    dec_g = 27.12825*deg
+    l_NGP = 122.93192*deg
+    dl = l_NGP - np.asarray(_l, dtype=float)*deg
+    b = np.asarray(_b, dtype=float)*deg
+    sindec = np.cos(b)*np.cos(dec_g)*np.cos(dl)+np.sin(b)*np.sin(dec_g)
+    cosdec_sinra = np.cos(b)*np.sin(dl)
+    cosdec_cosra = np.sin(b)*np.cos(dec_g)-np.cos(b)*np.sin(dec_g)*np.cos(dl)
+    dec = np.arcsin(np.clip(sindec, -1, 1))/deg
+    ra = (np.arctan2(cosdec_sinra, cosdec_cosra)/deg + ra_g/deg) % 360.0
+    return ra, dec
+
+def _unit_vectors(ra, dec):
+    ra, dec = np.radians(ra), np.radians(dec)
+    return np.column_stack([np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec)])
+
+def build_index(field_names, ra0, dec0):
+    """
+    Compute the geometry index for a set of OGLE-IV fields.
+    inputs:
+        field_names: field names (e.g. 'BLG501')
+        ra0, dec0: field centres (deg)
+    output:
+        dictionary of arrays: field names and centres, field vertices (n_fields, 12)
+        and subfield vertices (n_fields, 32, 4) in equatorial and Galactic coordinates
+    """
+    names = np.asarray(field_names).astype(str)
+    ra0 = np.asarray(ra0, dtype=float)
+    dec0 = np.asarray(dec0, dtype=float)
+    pixra = pix_deg / np.cos(dec0*np.pi/180.0)
+    field_ra = ra0[:,None] + field_x[None,:]*pixra[:,None]
+    field_dec = dec0[:,None] + field_y[None,:]*pix_deg
+    sub_ra = ra0[:,None,None] + chip_x[None]*pixra[:,None,None]
+    sub_dec = dec0[:,None,None] + chip_y[None]*pix_deg
+    field_l, field_b = ogle_utils.equatorial_to_galactic(field_ra, field_dec)
+    sub_l, sub_b = ogle_utils.equatorial_to_galactic(sub_ra, sub_dec)
+    cen_l, cen_b = ogle_utils.equatorial_to_galactic(ra0.copy(), dec0.copy())
+    return {'field':names, 'ra0':ra0, 'dec0':dec0, 'l0':cen_l, 'b0':cen_b,
+            'field_ra':field_ra, 'field_dec':field_dec, 'field_l':field_l, 'field_b':field_b,
+            'sub_ra':sub_ra, 'sub_dec':sub_dec, 'sub_l':sub_l, 'sub_b':sub_b}
+
+def _fields_hash(names, ra0, dec0):
+    h = hashlib.sha1()
+    h.update('|'.join(np.asarray(names).astype(str)).encode())
+    h.update(np.ascontiguousarray(ra0, dtype=float).tobytes())
+    h.update(np.ascontiguousarray(dec0, dtype=float).tobytes())
+    return h.hexdigest()
+
+def load_index(cache_file='data/ogle_geometry.npz', ogle_fields=None):
+    """
+    Load the geometry index from its cache, building (and caching) it first if needed.
+    ogle_fields defaults to the Mroz et al. 2019 field table from fetch_data,
+    indexed by field name with RAdeg and DEdeg columns.
+    """
+    if ogle_fields is None and os.path.isfile(cache_file):
+        with np.load(cache_file, allow_pickle=False) as npz:
+            return {key: npz[key] for key in npz.files if key!='hash'}
+    if ogle_fields is None:
+        import fetch_data
+        ogle_fields = fetch_data.ogle_mroz2019()[1]
+    names = ogle_fields.index.to_numpy().astype(str)
+    ra0, dec0 = ogle_fields['RAdeg'].to_numpy(), ogle_fields['DEdeg'].to_numpy()
+    fhash = _fields_hash(names, ra0, dec0)
+    if os.path.isfile(cache_file):
+        with np.load(cache_file, allow_pickle=False) as npz:
+            if str(npz['hash'])==fhash:
+                return {key: npz[key] for key in npz.files if key!='hash'}
+    index = build_index(names, ra0, dec0)
+    cache_dir = os.path.dirname(cache_file)
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+    tmp = cache_file[:-4]+f'.{os.getpid()}.tmp.npz'
+    np.savez(tmp, hash=np.array(fhash), **index)
+    os.replace(tmp, cache_file)
+    return index
+
+def _chip_from_offsets(x, y):
+    # Chip number (1-32) for pixel offsets from the field centre, 0 if in no chip
+    chip = np.zeros(len(x), dtype=np.int64)
+    for first, n, x_hi, y_lo, y_hi in chip_rows:
+        k = np.floor((x_hi-x)/chip_step)
+        in_row = (y>=y_lo) & (y<=y_hi) & (k>=0) & (k<n) & (x_hi-k*chip_step-x<=chip_width)
+        chip[in_row] = first + k[in_row].astype(np.int64)
+    return chip
+
+def assign_subfields(l, b, index, n_near=4, max_sep=1.0):
+    """
+    Assign points to OGLE-IV subfields.
+    inputs:
+        l, b: Galactic coordinates (deg) of stars or events
+        index: geometry index from load_index or build_index
+        n_near: number of nearest field centres tested (fields overlap slightly)
+        max_sep: maximum distance from a field centre (deg) to be considered
+    output:
+        array of subfield codes, field_index*32 + (chip-1), or -1 outside all subfields;
+        where fields overlap, the nearest field wins
+    """
+    ra, dec = galactic_to_equatorial(l, b)
+    ra, dec = np.atleast_1d(ra), np.atleast_1d(dec)
+    ra0, dec0 = index['ra0'], index['dec0']
+    nf = len(ra0)
+    tree = cKDTree(_unit_vectors(ra0, dec0))
+    chord = 2*np.sin(np.radians(max_sep)/2)
+    k = min(n_near, nf)
+    _, near = tree.query(_unit_vectors(ra, dec), k=k, distance_upper_bound=chord)
+    near = near.reshape(len(ra), k)
+
+    codes = np.full(len(ra), -1, dtype=np.int64)
+    for j in range(k):
+        todo = (codes<0) & (near[:,j]<nf)
+        if not np.any(todo):
+            continue
+        fi = near[todo, j]
+        dra = (ra[todo]-ra0[fi]+180.0) % 360.0 - 180.0
+        x = dra*np.cos(dec0[fi]*np.pi/180.0)/pix_deg
+        y = (dec[todo]-dec0[fi])/pix_deg
+        chip = _chip_from_offsets(x, y)
+        hit = chip>0
+        sel = np.flatnonzero(todo)[hit]
+        codes[sel] = fi[hit]*n_chips + chip[hit]-1
+    return codes
+
+def subfield_names(codes, index):
+    """
+    Subfield names (e.g. 'BLG501.01') for subfield codes; '' for -1.
+    """
+    codes = np.asarray(codes)
+    all_names = np.char.add(np.repeat(index['field'], n_chips),
+                            np.tile(np.char.add('.', np.char.zfill(np.arange(1, n_chips+1).astype(str), 2)),
+                                    len(index['field'])))
+    return np.where(codes>=0, all_names[np.maximum(codes, 0)], '')
+
+def subfield_codes(names, index):
+    """
+    Subfield codes for subfield names (e.g. 'BLG501.01'); -1 for unknown names.
+    """
+    lookup = {f:i for i,f in enumerate(index['field'])}
+    names = np.asarray(names).astype(str)
+    parts = np.char.partition(names, '.')
+    fi = np.array([lookup.get(f, -1) for f in parts[:,0]], dtype=np.int64)
+    chip = np.array([int(c) if c.isdigit() else 0 for c in parts[:,2]], dtype=np.int64)
+    ok = (fi>=0) & (chip>=1) & (chip<=n_chips)
+    return np.where(ok, fi*n_chips+chip-1, -1)
+
+def subfield_polygons(index, codes=None):
+    """
+    Galactic (l,b) vertices of subfields, shape (n, 4, 2), e.g. for a PatchCollection.
+    codes selects subfields (default: all, in code order).
+    """
+    verts = np.stack([index['sub_l'], index['sub_b']], axis=-1).reshape(-1, 4, 2)
+    return verts if codes is None else verts[np.asarray(codes)]
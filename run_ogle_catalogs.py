@@ -0,0 +1,10 @@
+import pandas as pd
+import field_driver
+
+# Generate the OGLE chip lens and source catalogs side by side
+if __name__ == '__main__':
+    flds = pd.read_csv('subfs_inmap.csv')
+    field_driver.run_fields(flds, {'lens': field_driver.ogle_lens_kwargs,
+                                   'src': field_driver.ogle_src_kwargs},
+                            manifest_file='outputfiles/ogle_chips/manifest.csv',
+                            solang_method='prepass')
@@ -0,0 +1,330 @@
+"""
+Local, spatially indexed cache of survey catalog rows (VIRAC2, Gaia) for
+the evaluations.
+
+The sky is divided into tiles in Galactic coordinates, in the spirit of
+HEALPix: rings of constant height in b, each split into equal steps in l with
+the number of steps set by cos(b), so that all tiles cover about the same
+area. A cone query finds the tiles it touches; tiles not yet in the cache are
+downloaded together with a single remote cone query circumscribing them, the
+rows are de-duplicated (by source id, else by position), given Galactic l, b,
+pml and pmb in one vectorized transform, and written once into the tile that
+contains them (as catalog_store fields, so reads memory-map the columns and
+range cuts are pushed down). Every later query touching only cached tiles, of
+any radius, is served locally without network access.
+
+The remote service is any function fetch(l, b, radius_deg) returning a
+DataFrame: vizier_fetcher and gaia_fetcher query the archives, and
+FileFetcher serves cones from a local catalog file instead, for offline use
+and tests.
+
+Usage:
+    virac = SurveyCache('virac2')
+    tab = virac.cone(1.1, -0.7, 0.05, where={'UWE': (None, 1.4)})
+"""
+
+import os
+import json
+import numpy as np
+import pandas as pd
+import catalog_store
+
+default_cache = 'data/survey_cache'
+
+# Column names of the supported surveys: source id, position and proper motion
+surveys = {'virac2': {'id':'srcid', 'ra':'RAJ2000', 'dec':'DEJ2000', 'pmra':'pmRA', 'pmdec':'pmDE'},
+           'gaia': {'id':'source_id', 'ra':'ra', 'dec':'dec', 'pmra':'pmra', 'pmdec':'pmdec'}}
+
+def angular_distance(l1, b1, l2, b2):
+    """
+    Angular distance (deg) between points, from the haversine formula.
+    """
+    l1, b1, l2, b2 = (np.radians(np.asarray(x, dtype=float)) for x in (l1, b1, l2, b2))
+    h = np.sin((b2-b1)/2)**2 + np.cos(b1)*np.cos(b2)*np.sin((l2-l1)/2)**2
+    return np.degrees(2*np.arcsin(np.sqrt(np.clip(h, 0, 1))))
+
+def to_galactic(ra, dec, pmra=None, pmdec=None):
+    """
+    Galactic l (in -180..180), b and, if proper motions are given, pml (=mu_l cos b)
+    and pmb, for arrays of equatorial positions (deg) and motions (mas/yr).
+    """
+    from astropy.coordinates import SkyCoord
+    from astropy import units as u
+    ra, dec = np.asarray(ra, dtype=float), np.asarray(dec, dtype=float)
+    if pmra is None:
+        gal = SkyCoord(ra=ra*u.deg, dec=dec*u.deg, frame='icrs').galactic
+        return gal.l.wrap_at(180*u.deg).deg, gal.b.deg
+    gal = SkyCoord(ra=ra*u.deg, dec=dec*u.deg, pm_ra_cosdec=np.asarray(pmra, dtype=float)*u.mas/u.yr,
+                   pm_dec=np.asarray(pmdec, dtype=float)*u.mas/u.yr, frame='icrs').galactic
+    return (gal.l.wrap_at(180*u.deg).deg, gal.b.deg,
+            gal.pm_l_cosb.to_value(u.mas/u.yr), gal.pm_b.to_value(u.mas/u.yr))
+
+class Tiling:
+    """
+    Equal-area tiling of the sky in Galactic coordinates, in rings of constant b.
+    inputs:
+        tile_deg: tile height in b, and approximate width in l cos b (deg)
+    Tiles are numbered ring by ring from b=-90, and in l from l=-180 within a ring.
+    """
+    def __init__(self, tile_deg=0.1):
+        self.tile_deg = tile_deg
+        self.n_rings = int(np.ceil(180/tile_deg))
+        self.ring_b = -90 + (np.arange(self.n_rings)+0.5)*180/self.n_rings
+        self.ring_n = np.maximum(1, np.round(360*np.cos(np.radians(self.ring_b))/tile_deg)).astype(np.int64)
+        self.ring_start = np.concatenate([[0], np.cumsum(self.ring_n)[:-1]])
+
+    def ring(self, b):
+        return np.clip(((np.asarray(b, dtype=float)+90)*self.n_rings/180).astype(np.int64), 0, self.n_rings-1)
+
+    def tile(self, l, b):
+        """
+        Tile numbers of points (l, b in deg).
+        """
+        ring = self.ring(b)
+        n = self.ring_n[ring]
+        col = np.floor(((np.asarray(l, dtype=float)+180) % 360)*n/360).astype(np.int64)
+        return self.ring_start[ring] + np.minimum(col, n-1)
+
+    def centre(self, tile):
+        """
+        Centres (l in -180..180, b) of tiles.
+        """
+        tile = np.asarray(tile, dtype=np.int64)
+        ring = np.searchsorted(self.ring_start, tile, side='right')-1
+        col = tile - self.ring_start[ring]
+        return -180 + (col+0.5)*360/self.ring_n[ring], self.ring_b[ring]
+
+    def half_diagonal(self, tile):
+        """
+        Upper bound on the distance (deg) from a tile's centre to its corners.
+        """
+        ring = np.searchsorted(self.ring_start, np.asarray(tile, dtype=np.int64), side='right')-1
+        height = 180/self.n_rings
+        # Width on the sky of the tile's edge nearer the equator, its widest
+        width = 360/self.ring_n[ring]*np.cos(np.radians(np.clip(np.abs(self.ring_b[ring])-height/2, 0, 90)))
+        return np.minimum(0.505*np.hypot(width, height), 180)
+
+    def cone_tiles(self, l, b, radius):
+        """
+        Tiles overlapping the cone of the given radius (deg) around (l, b).
+        """
+        r_tile = np.hypot(self.tile_deg, self.tile_deg)
+        lo, hi = self.ring(max(b-radius-r_tile, -90)), self.ring(min(b+radius+r_tile, 90))
+        tiles = []
+        for ring in range(lo, hi+1):
+            n = self.ring_n[ring]
+            cosb = np.cos(np.radians(min(abs(self.ring_b[ring])+180/self.n_rings, 90)))
+            dl = 180 if cosb<=0 else min((radius+r_tile)/cosb, 180)
+            if dl>=180:
+                cols = np.arange(n)
+            else:
+                c0 = int(np.floor(((l-dl+180) % 360)*n/360))
+                cols = (c0 + np.arange(int(np.ceil(2*dl*n/360))+2)) % n
+            tiles.append(self.ring_start[ring] + np.unique(cols))
+        tiles = np.concatenate(tiles)
+        cl, cb = self.centre(tiles)
+        return tiles[angular_distance(l, b, cl, cb) <= radius+self.half_diagonal(tiles)]
+
+class SurveyCache:
+    """
+    Tile-partitioned local cache of one survey's catalog.
+    inputs:
+        survey: survey name (a key of surveys, or any name if columns is given)
+        cache_dir: cache location; the survey's tiles go in cache_dir/survey
+        fetch: remote cone query fetch(l, b, radius_deg) -> DataFrame (default:
+            vizier_fetcher() for virac2, gaia_fetcher() for gaia)
+        tile_deg: tile size (deg, at least 0.01); fixed when the cache is first created
+        columns: column names {'id', 'ra', 'dec', 'pmra', 'pmdec'} (default: surveys[survey]);
+            id may be None to de-duplicate by position
+    """
+    def __init__(self, survey, cache_dir=default_cache, fetch=None, tile_deg=0.1, columns=None):
+        self.survey = survey
+        self.columns = dict(surveys[survey] if columns is None else columns)
+        self.store_dir = os.path.join(cache_dir, survey)
+        if fetch is None and survey=='virac2':
+            fetch = vizier_fetcher()
+        elif fetch is None and survey=='gaia':
+            fetch = gaia_fetcher()
+        self.fetch = fetch
+        self.manifest_file = os.path.join(self.store_dir, 'tiles.json')
+        self.manifest = self._read_manifest(tile_deg)
+        self.tiling = Tiling(self.manifest['tile_deg'])
+
+    def _read_manifest(self, tile_deg):
+        if os.path.isfile(self.manifest_file):
+            with open(self.manifest_file) as f:
+                return json.load(f)
+        return {'survey':self.survey, 'tile_deg':tile_deg, 'tiles':{}}
+
+    def _write_manifest(self):
+        os.makedirs(self.store_dir, exist_ok=True)
+        tmp = self.manifest_file+f'.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp, self.manifest_file)
+
+    def missing_tiles(self, tiles):
+        """
+        The tiles, of those given, not yet in the cache.
+        """
+        return np.array([t for t in tiles if str(t) not in self.manifest['tiles']], dtype=np.int64)
+
+    def _prepare(self, df):
+        # De-duplicate and add Galactic coordinates and proper motions
+        cols = self.columns
+        for col in df.columns:
+            if pd.api.types.is_numeric_dtype(df[col].dtype) and not isinstance(df[col].dtype, np.dtype):
+                # Nullable (masked) columns are stored as float with NaN
+                df[col] = df[col].to_numpy(dtype=float, na_value=np.nan)
+        if cols.get('id') is not None and cols['id'] in df.columns:
+            df = df.drop_duplicates(cols['id'])
+        else:
+            key = np.round(df[[cols['ra'], cols['dec']]].to_numpy(dtype=float)*3.6e6).astype(np.int64)
+            df = df[~pd.DataFrame(key).duplicated().to_numpy()]
+        df = df.reset_index(drop=True)
+        if cols.get('pmra') in df.columns and cols.get('pmdec') in df.columns:
+            df['l'], df['b'], df['pml'], df['pmb'] = to_galactic(df[cols['ra']], df[cols['dec']],
+                                                                 df[cols['pmra']], df[cols['pmdec']])
+        else:
+            df['l'], df['b'] = to_galactic(df[cols['ra']], df[cols['dec']])
+        return df
+
+    def fill(self, tiles):
+        """
+        Download the given tiles (those not yet cached) with one remote cone query.
+        output:
+            number of tiles added
+        """
+        tiles = self.missing_tiles(tiles)
+        if len(tiles)==0:
+            return 0
+        if self.fetch is None:
+            raise ValueError(f'No remote fetcher for survey {self.survey}')
+        cl, cb = self.tiling.centre(tiles)
+        # Cone circumscribing the tiles, centred on their mean direction
+        vec = np.array([np.cos(np.radians(cb))*np.cos(np.radians(cl)),
+                        np.cos(np.radians(cb))*np.sin(np.radians(cl)), np.sin(np.radians(cb))]).sum(axis=1)
+        l0 = float(np.degrees(np.arctan2(vec[1], vec[0])))
+        b0 = float(np.degrees(np.arctan2(vec[2], np.hypot(vec[0], vec[1]))))
+        radius = float(np.max(angular_distance(l0, b0, cl, cb) + self.tiling.half_diagonal(tiles)))
+        df = self.fetch(l0, b0, radius)
+        if len(df)==0:
+            # Nothing in the cone (sparse or masked region): the tiles are cached as empty
+            for tile, tl, tb in zip(tiles, cl, cb):
+                self.manifest['tiles'][str(tile)] = {'l':float(tl), 'b':float(tb), 'n_rows':0}
+            self._write_manifest()
+            return len(tiles)
+        df = self._prepare(df)
+        self.manifest.setdefault('columns', [str(col) for col in df.columns])
+        row_tile = self.tiling.tile(df['l'].to_numpy(), df['b'].to_numpy())
+        # Rows of tiles already cached, or outside the requested tiles, are dropped
+        keep = np.isin(row_tile, tiles)
+        df, row_tile = df[keep], row_tile[keep]
+        order = np.argsort(row_tile, kind='stable')
+        df, row_tile = df.iloc[order].reset_index(drop=True), row_tile[order]
+        starts = np.searchsorted(row_tile, tiles)
+        stops = np.searchsorted(row_tile, tiles, side='right')
+        for tile, start, stop, tl, tb in zip(tiles, starts, stops, cl, cb):
+            if stop>start:
+                catalog_store.write_field(df.iloc[start:stop], tl, tb, self.store_dir)
+            self.manifest['tiles'][str(tile)] = {'l':float(tl), 'b':float(tb), 'n_rows':int(stop-start)}
+        self._write_manifest()
+        return len(tiles)
+
+    def schema(self):
+        """
+        Columns of the cached rows: as stored once any rows have been cached,
+        else the survey's key columns plus l, b, pml and pmb.
+        """
+        if 'columns' in self.manifest:
+            return list(self.manifest['columns'])
+        keys = [self.columns.get(key) for key in ['id', 'ra', 'dec', 'pmra', 'pmdec']]
+        gal = ['l', 'b', 'pml', 'pmb'] if self.columns.get('pmra') is not None else ['l', 'b']
+        return [col for col in keys if col is not None] + gal
+
+    def cone(self, l, b, radius, columns=None, where=None, offline=False):
+        """
+        Survey rows within radius (deg) of (l, b), from the cache, downloading
+        missing tiles first.
+        inputs:
+            l, b: cone centre (deg)
+            radius: cone radius (deg)
+            columns: columns to return (default: all)
+            where: optional range cuts {column: (lo, hi)} (see catalog_store.read_field)
+            offline: if True, raise instead of downloading missing tiles
+        output:
+            DataFrame including l, b, pml and pmb (mas/yr); if no rows fall in
+            the cone, an empty DataFrame with the requested columns (default:
+            schema())
+        """
+        tiles = self.tiling.cone_tiles(l, b, radius)
+        missing = self.missing_tiles(tiles)
+        if len(missing)>0:
+            if offline:
+                raise KeyError(f'{len(missing)} tiles of the cone ({l}, {b}, {radius}) are not cached')
+            self.fill(missing)
+        read_cols = None if columns is None else list(dict.fromkeys(list(columns)+['l', 'b']))
+        parts = []
+        for tile in tiles:
+            info = self.manifest['tiles'][str(tile)]
+            if info['n_rows']>0:
+                parts.append(catalog_store.read_field(info['l'], info['b'], self.store_dir,
+                                                      columns=read_cols, where=where))
+        if len(parts)==0:
+            return pd.DataFrame(columns=list(columns) if columns is not None else self.schema())
+        df = pd.concat(parts, ignore_index=True)
+        df = df[angular_distance(l, b, df['l'].to_numpy(), df['b'].to_numpy()) <= radius]
+        if columns is not None:
+            df = df[list(columns)]
+        return df.reset_index(drop=True)
+
+def vizier_fetcher(catalog='II/387/virac2', columns=['**']):
+    """
+    Remote cone query of a Vizier catalog (all rows), as fetch(l, b, radius_deg).
+    """
+    def fetch(l, b, radius):
+        from astroquery.vizier import Vizier
+        from astropy.coordinates import SkyCoord
+        from astropy import units as u
+        v = Vizier(catalog=catalog, columns=columns, row_limit=-1)
+        result = v.query_region(SkyCoord(l, b, unit=u.deg, frame='galactic'), radius=radius*u.deg)
+        if len(result)==0:
+            return pd.DataFrame()
+        return result[0].to_pandas()
+    return fetch
+
+def gaia_fetcher(table='gaiadr3.gaia_source',
+                 columns=['source_id', 'ra', 'dec', 'pmra', 'pmdec', 'pmra_error', 'pmdec_error',
+                          'parallax', 'phot_g_mean_mag', 'phot_bp_mean_mag', 'phot_rp_mean_mag', 'ruwe']):
+    """
+    Remote ADQL cone query of the Gaia archive, as fetch(l, b, radius_deg).
+    """
+    def fetch(l, b, radius):
+        from astroquery.gaia import Gaia
+        from astropy.coordinates import SkyCoord
+        from astropy import units as u
+        eq = SkyCoord(l, b, unit=u.deg, frame='galactic').icrs
+        query = (f"SELECT {', '.join(columns)} FROM {table} WHERE 1=CONTAINS(POINT('ICRS', ra, dec), "
+                 f"CIRCLE('ICRS', {eq.ra.deg:.8f}, {eq.dec.deg:.8f}, {radius:.8f}))")
+        return Gaia.launch_job_async(query).get_results().to_pandas()
+    return fetch
+
+class FileFetcher:
+    """
+    Stand-in for a remote service: serves cone queries from a local catalog
+    file (csv or h5) or DataFrame with equatorial positions. Each query is
+    recorded in .calls as (l, b, radius).
+    inputs:
+        catalog: file name or DataFrame
+        ra, dec: position columns (deg)
+    """
+    def __init__(self, catalog, ra='ra', dec='dec'):
+        if isinstance(catalog, str):
+            catalog = pd.read_csv(catalog) if catalog.endswith('.csv') else pd.read_hdf(catalog)
+        self.catalog = catalog
+        self.l, self.b = to_galactic(catalog[ra], catalog[dec])
+        self.calls = []
+
+    def __call__(self, l, b, radius):
+        self.calls.append((l, b, radius))
+        return self.catalog[angular_distance(l, b, self.l, self.b) <= radius].copy()
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+from scipy.spatial import cKDTree
+import blending
+
+def sequential_groups(l, b, mags, blend_rad):
+    # Reference: brightest first, each ungrouped star takes all ungrouped stars within blend_rad
+    lw = l - 360*(l>180)
+    x = (lw-np.median(lw))*np.cos(b*np.pi/180)
+    tree = cKDTree(np.column_stack([x, b]))
+    groups = np.full(len(l), -1, dtype=np.int64)
+    for s in np.argsort(mags, kind='stable'):
+        if groups[s]>=0:
+            continue
+        near = np.array(tree.query_ball_point([x[s], b[s]], blend_rad), dtype=np.int64)
+        groups[near[groups[near]<0]] = s
+    return groups
+
+def crowded_field(n, seed, blend_rad):
+    # About 3 neighbours per star, so long brightness chains are common
+    rng = np.random.default_rng(seed)
+    side = np.sqrt(n*np.pi*blend_rad**2/3)
+    l = 1 + rng.uniform(0, side, n)
+    b = -3 + rng.uniform(0, side, n)
+    mags = rng.uniform(12, 22, n)
+    return l, b, mags
+
+@pytest.mark.parametrize('chunk_size', [1000000, 2000, 777])
+def test_matches_sequential_reference(chunk_size):
+    blend_rad = 0.45/2/3600
+    l, b, mags = crowded_field(6000, 1, blend_rad)
+    ref = sequential_groups(l, b, mags, blend_rad)
+    groups = blending.find_blend_groups(l, b, mags, blend_rad=blend_rad, chunk_size=chunk_size)
+    np.testing.assert_array_equal(groups, ref)
+
+def test_ties_and_nan_magnitudes():
+    blend_rad = 0.45/2/3600
+    l, b, mags = crowded_field(3000, 2, blend_rad)
+    mags = np.round(mags)
+    mags[::7] = np.nan
+    ref = sequential_groups(l, b, mags, blend_rad)
+    for chunk_size in [1000000, 500]:
+        groups = blending.find_blend_groups(l, b, mags, blend_rad=blend_rad, chunk_size=chunk_size)
+        np.testing.assert_array_equal(groups, ref)
+
+def test_blend_fluxes_conserve_flux():
+    blend_rad = 0.45/2/3600
+    l, b, mags = crowded_field(2000, 3, blend_rad)
+    groups = blending.find_blend_groups(l, b, mags, blend_rad=blend_rad)
+    centres, blend_mags, n_blend = blending.blend_fluxes(groups, mags)
+    assert n_blend.sum()==len(mags)
+    assert np.isclose(blending.magsum(blend_mags), blending.magsum(mags))
+    # The centre of every group is its brightest star
+    assert np.all(groups[centres]==centres)
+    assert np.all(mags[groups] <= mags)
+    assert np.all(blend_mags <= mags[centres] + 1e-9)
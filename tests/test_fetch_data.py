@@ -0,0 +1,99 @@
+import os
+import json
+import pandas as pd
+import pytest
+import fetch_data
+
+def make_mirror(tmp_path, files):
+    # Local stand-in for the remote server, served as a file:// url_base
+    mirror = tmp_path/'mirror'
+    mirror.mkdir()
+    for name, text in files.items():
+        (mirror/name).write_text(text)
+    return mirror, mirror.as_uri()+'/'
+
+def read_manifest(location):
+    with open(os.path.join(location, fetch_data.manifest_name)) as f:
+        return json.load(f)
+
+def leftovers(location):
+    return [f for f in os.listdir(location) if f.endswith('.tmp')]
+
+def test_download_and_manifest(tmp_path):
+    mirror, url = make_mirror(tmp_path, {'a.txt':'1 2\n3 4\n', 'b.txt':'5 6\n'})
+    location = str(tmp_path/'data')
+    paths = fetch_data.fetch_files(['a.txt', ('b.txt', 'b_local.txt')], location, url)
+    assert [os.path.basename(p) for p in paths] == ['a.txt', 'b_local.txt']
+    manifest = read_manifest(location)
+    for local, remote in [('a.txt', 'a.txt'), ('b_local.txt', 'b.txt')]:
+        path = os.path.join(location, local)
+        assert open(path).read() == (mirror/remote).read_text()
+        assert manifest[local]['sha256'] == fetch_data.file_sha256(path)
+        assert manifest[local]['size'] == os.path.getsize(path)
+        assert manifest[local]['url'] == url+remote
+    assert leftovers(location) == []
+
+def test_warm_start_is_offline(tmp_path):
+    mirror, url = make_mirror(tmp_path, {'a.txt':'1 2\n'})
+    location = str(tmp_path/'data')
+    fetch_data.fetch_files(['a.txt'], location, url)
+    os.remove(mirror/'a.txt')
+    # Intact files are neither downloaded nor checked against the server again
+    path = fetch_data.fetch_files(['a.txt'], location, url)[0]
+    assert open(path).read() == '1 2\n'
+
+def test_corrupt_and_empty_files_are_fetched_again(tmp_path):
+    mirror, url = make_mirror(tmp_path, {'a.txt':'1 2\n', 'b.txt':'3 4\n'})
+    location = str(tmp_path/'data')
+    pa, pb = fetch_data.fetch_files(['a.txt', 'b.txt'], location, url)
+    # Same size, different content: only caught by the checksum
+    with open(pa, 'w') as f:
+        f.write('9 9\n')
+    open(pb, 'w').close()
+    fetch_data.fetch_files(['a.txt', 'b.txt'], location, url, verify=False)
+    assert open(pa).read() == '9 9\n'
+    assert open(pb).read() == '3 4\n'
+    fetch_data.fetch_files(['a.txt', 'b.txt'], location, url)
+    assert open(pa).read() == '1 2\n'
+
+def test_errors_are_aggregated(tmp_path):
+    mirror, url = make_mirror(tmp_path, {'good.txt':'1\n', 'empty.txt':''})
+    location = str(tmp_path/'data')
+    with pytest.raises(OSError) as err:
+        fetch_data.fetch_files(['good.txt', 'missing.txt', 'empty.txt'], location, url)
+    assert 'missing.txt' in str(err.value) and 'empty.txt' in str(err.value)
+    # The good file is still fetched and recorded; failed ones leave nothing behind
+    assert sorted(read_manifest(location)) == ['good.txt']
+    assert sorted(os.listdir(location)) == [fetch_data.manifest_name, 'good.txt']
+
+def test_failed_download_keeps_old_file(tmp_path):
+    mirror, url = make_mirror(tmp_path, {'a.txt':'1 2\n'})
+    location = str(tmp_path/'data')
+    path = fetch_data.fetch_files(['a.txt'], location, url)[0]
+    with open(path, 'w') as f:
+        f.write('corrupt')
+    os.remove(mirror/'a.txt')
+    with pytest.raises(OSError):
+        fetch_data.fetch_files(['a.txt'], location, url)
+    # The file is only replaced by a complete download
+    assert open(path).read() == 'corrupt'
+    assert leftovers(location) == []
+
+def test_cached_frame(tmp_path):
+    mirror, url = make_mirror(tmp_path, {'t.txt':'1 2\n3 4\n'})
+    location = str(tmp_path/'data')
+    calls = []
+    def parse(path):
+        calls.append(path)
+        return pd.read_csv(path, sep=' ', header=None, names=['x', 'y'])
+    path = fetch_data.fetch_files(['t.txt'], location, url)[0]
+    first = fetch_data.cached_frame(path, parse, location)
+    again = fetch_data.cached_frame(path, parse, location)
+    assert len(calls) == 1
+    pd.testing.assert_frame_equal(first, again)
+    # A changed source file (new checksum) is parsed again
+    (mirror/'t.txt').write_text('5 6\n7 8\n9 0\n')
+    os.remove(path)
+    fetch_data.fetch_files(['t.txt'], location, url)
+    assert len(fetch_data.cached_frame(path, parse, location)) == 3
+    assert len(calls) == 2
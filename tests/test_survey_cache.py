@@ -0,0 +1,84 @@
+import numpy as np
+import pandas as pd
+import pytest
+import survey_cache
+
+columns = {'id':'srcid', 'ra':'ra', 'dec':'dec', 'pmra':'pmra', 'pmdec':'pmdec'}
+
+def local_catalog(n, seed, l0=1.0, b0=-3.0, size=0.6):
+    # Uniform stars in a box around (l0, b0), with equatorial positions as a survey gives them
+    from astropy.coordinates import SkyCoord
+    from astropy import units as u
+    rng = np.random.default_rng(seed)
+    gal = SkyCoord(l0+rng.uniform(-size/2, size/2, n), b0+rng.uniform(-size/2, size/2, n),
+                   unit=u.deg, frame='galactic').icrs
+    return pd.DataFrame({'srcid':np.arange(n), 'ra':gal.ra.deg, 'dec':gal.dec.deg,
+                         'pmra':rng.normal(-3, 3, n), 'pmdec':rng.normal(-5, 3, n),
+                         'mag':rng.uniform(11, 18, n)})
+
+def in_cone(fetch, l, b, radius):
+    # Direct query of the stand-in service's catalog
+    return survey_cache.angular_distance(l, b, fetch.l, fetch.b) <= radius
+
+def empty_fetcher(calls):
+    # Remote service with nothing in any cone, answering like vizier_fetcher
+    def fetch(l, b, radius):
+        calls.append((l, b, radius))
+        return pd.DataFrame()
+    return fetch
+
+def test_cone_matches_direct_query(tmp_path):
+    fetch = survey_cache.FileFetcher(local_catalog(20000, 1))
+    cache = survey_cache.SurveyCache('test', cache_dir=str(tmp_path), fetch=fetch, columns=columns)
+    for l, b, radius in [(1.0, -3.0, 0.05), (1.1, -2.9, 0.12), (0.95, -3.05, 0.02)]:
+        tab = cache.cone(l, b, radius)
+        direct = fetch.catalog[in_cone(fetch, l, b, radius)]
+        assert sorted(tab['srcid']) == sorted(direct['srcid'])
+    assert {'l', 'b', 'pml', 'pmb'} <= set(tab.columns)
+
+def test_requery_is_local(tmp_path):
+    fetch = survey_cache.FileFetcher(local_catalog(5000, 2))
+    cache = survey_cache.SurveyCache('test', cache_dir=str(tmp_path), fetch=fetch, columns=columns)
+    first = cache.cone(1.0, -3.0, 0.1)
+    n_calls = len(fetch.calls)
+    assert n_calls>0
+    # Same cone, a smaller one inside it, and a fresh cache object on the same directory
+    again = cache.cone(1.0, -3.0, 0.1)
+    cache.cone(1.02, -3.01, 0.03)
+    reopened = survey_cache.SurveyCache('test', cache_dir=str(tmp_path), fetch=fetch, columns=columns)
+    reread = reopened.cone(1.0, -3.0, 0.1, where={'mag':(None, 15)})
+    assert len(fetch.calls)==n_calls
+    pd.testing.assert_frame_equal(first, again)
+    assert sorted(reread['srcid']) == sorted(first.loc[first['mag']<15, 'srcid'])
+
+def test_offline(tmp_path):
+    fetch = survey_cache.FileFetcher(local_catalog(5000, 3))
+    cache = survey_cache.SurveyCache('test', cache_dir=str(tmp_path), fetch=fetch, columns=columns)
+    with pytest.raises(KeyError):
+        cache.cone(1.0, -3.0, 0.05, offline=True)
+    tab = cache.cone(1.0, -3.0, 0.05)
+    offline = survey_cache.SurveyCache('test', cache_dir=str(tmp_path), fetch=None, columns=columns)
+    pd.testing.assert_frame_equal(offline.cone(1.0, -3.0, 0.05, offline=True), tab)
+
+def test_empty_fetch(tmp_path):
+    calls = []
+    cache = survey_cache.SurveyCache('test', cache_dir=str(tmp_path), fetch=empty_fetcher(calls),
+                                     columns=columns)
+    tab = cache.cone(1.0, -3.0, 0.05)
+    assert len(tab)==0
+    assert list(tab.columns) == ['srcid', 'ra', 'dec', 'pmra', 'pmdec', 'l', 'b', 'pml', 'pmb']
+    assert list(cache.cone(1.0, -3.0, 0.05, columns=['ra', 'pml']).columns) == ['ra', 'pml']
+    # The empty tiles are cached, so they are not fetched again
+    assert len(calls)==1
+    cache.cone(1.0, -3.0, 0.05, offline=True)
+    assert len(calls)==1
+
+def test_empty_tiles_keep_stored_schema(tmp_path):
+    # Stars only near b=-3: a cone far from them touches only empty tiles
+    fetch = survey_cache.FileFetcher(local_catalog(2000, 4, size=0.2))
+    cache = survey_cache.SurveyCache('test', cache_dir=str(tmp_path), fetch=fetch, columns=columns)
+    full = cache.cone(1.0, -3.0, 0.05)
+    empty = cache.cone(1.0, -4.0, 0.05)
+    assert len(full)>0 and len(empty)==0
+    assert list(empty.columns) == list(full.columns)
+    assert 'mag' in empty.columns